@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch mode: convert all images of a directory (or glob pattern) into mosaics
+=======================================================================
+Images are distributed across a pool of worker processes, each worker keeps
+its own MosaicPipeline (i.e. loads the HED network only once).
+For each image the mosaic (svg and/or png) and a metrics record (json) are
+written into the output directory. Failing images are reported and skipped.
+"""
+
+import matplotlib
+matplotlib.use('Agg') # no display needed
+import glob
+import json
+import os
+import time
+import traceback
+from dataclasses import replace
+from multiprocessing import Pool
+from pathlib import Path
+import export
+import render
+from pipeline import MosaicConfig, MosaicPipeline
+
+IMAGE_SUFFIXES = ['.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp']
+
+
+def find_images(inputs):
+    # inputs: directory or glob pattern
+    if Path(inputs).is_dir():
+        fnames = [f for f in Path(inputs).iterdir() if f.suffix.lower() in IMAGE_SUFFIXES]
+    else:
+        fnames = [Path(f) for f in glob.glob(str(inputs), recursive=True)]
+    return sorted(fnames)
+
+
+def output_names(fnames):
+    # file name stems for the results, unique even for a.jpg/a.png or equal names in subdirectories
+    stems = [Path(f).stem for f in fnames]
+    root = os.path.commonpath([str(Path(f).absolute().parent) for f in fnames]) if fnames else ''
+    taken = {'batch_summary'}
+    names = []
+    for f,stem in zip(fnames, stems):
+        name = stem
+        if stems.count(stem) > 1 or name in taken:
+            name = '_'.join(Path(f).absolute().relative_to(root).with_suffix('').parts) + '_' + Path(f).suffix.lstrip('.')
+        base, i = name, 1
+        while name in taken:
+            i += 1
+            name = f'{base}_{i}'
+        taken.add(name)
+        names += [name]
+    return names
+
+
+_pipeline = None # one pipeline per worker process
+
+def _init_worker(config):
+    # (the HED network is loaded with the first image: if that fails, the error is recorded for each image
+    #  instead of killing the worker, which the pool would start again and again)
+    global _pipeline
+    _pipeline = MosaicPipeline(config, memoize=False) # every image is new => nothing to reuse
+
+
+def _process(task):
+    fname, name, out_dir, formats, scale = task
+    record = dict(fname=str(fname), pid=os.getpid())
+    t0 = time.time()
+    try:
+        result = _pipeline.run(fname)
+        stem = Path(out_dir) / name
+        for fmt in ['svg', 'svgz']:
+            if fmt in formats:
+                export.write_svg(result.polygons, result.colors, result.h, result.w, f'{stem}.{fmt}')
+        if 'npz' in formats:
+            result.tileset().save(f'{stem}.npz')
+        for fmt in ['png', 'tif']:
+            if fmt in formats:
+                render.write_image(result.polygons, result.colors, result.h, result.w, f'{stem}.{fmt}', scale=scale)
+        record.update(status='ok', tiles=len(result.polygons), h=result.h, w=result.w,
+                      timings=result.timings, stages=result.metrics['stages'])
+    except Exception as e:
+        record.update(status='failed', error=repr(e), traceback=traceback.format_exc())
+    record['seconds'] = time.time()-t0
+    with open(Path(out_dir) / f'{name}.json', 'w') as fn:
+        json.dump(record, fn, indent=1)
+    return record
+
+
+def run_batch(inputs, out_dir, config=None, processes=None, formats=('svg',), scale=1.0):
+    # processes: number of worker processes (None => all cores)
+    # scale: size of raster images (png, tif) relative to the prepared image
+    fnames = find_images(inputs)
+    processes = processes or os.cpu_count()
+    config = config or MosaicConfig()
+    # no interim plots; one openCV thread per worker and no parallel placement as the workers already use all cores
+    config = replace(config, plot=[], partitions=None,
+                     hed_threads=1 if processes>1 and config.hed_threads is None else config.hed_threads)
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    print (f'Processing {len(fnames)} images with {processes} processes')
+
+    t_start = time.time()
+    records = []
+    tasks = [(fname, name, out_dir, formats, scale) for fname,name in zip(fnames, output_names(fnames))]
+    with Pool(processes, initializer=_init_worker, initargs=(config,)) as pool:
+        for record in pool.imap_unordered(_process, tasks):
+            records += [record]
+            print (f'[{len(records)}/{len(fnames)}] {record["status"]}: {record["fname"]}', f'{record["seconds"]:.1f}s')
+
+    total = time.time()-t_start
+    failed = [r['fname'] for r in records if r['status'] != 'ok']
+    done = len(records)-len(failed)
+    summary = dict(images=len(records), done=done, failed=failed, seconds=total, processes=processes,
+                   images_per_min=60*done/total if total else 0.0, # only successfully converted images
+                   tiles=sum(r.get('tiles', 0) for r in records))
+    with open(Path(out_dir) / 'batch_summary.json', 'w') as fn:
+        json.dump(summary, fn, indent=1)
+    print (f'{done} of {len(records)} images done, {summary["images_per_min"]:.1f} images/min')
+    return summary
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the mosaic pipeline
+=======================================================================
+Runs each stage for a matrix of test images (from scikit-image), image widths
+and tile sizes and saves time, peak memory and tile count as json file.
+Time and memory are measured in separate passes (tracemalloc slows down the stages).
+Results can be compared against a stored baseline:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --output new.json --compare baseline.json
+"""
+
+import matplotlib
+matplotlib.use('Agg') # no display needed
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import traceback
+import tracemalloc
+from pathlib import Path
+import numpy as np
+import scipy
+import shapely
+import skimage as sk
+import convex, coloring, guides, render, tiles
+from pipeline import MosaicConfig, MosaicPipeline
+
+IMAGES = ['coffee', 'astronaut', 'chelsea', 'rocket']
+WIDTHS = [450, 900, 1800] # upscaled resolutions
+HALF_TILES = [4, 8, 12, 30]
+
+
+def default_edge_detection():
+    hed_model = Path(__file__).parent.absolute() / 'HED' / 'hed_pretrained_bsds.caffemodel'
+    return 'HED' if hed_model.exists() else 'DiBlasi'
+
+
+def measure(stages, name, func, *args, **kwargs):
+    # time (or peak memory of allocations during this stage in MB, if tracemalloc is running)
+    # => separate passes since tracemalloc slows down the stages considerably
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        out = func(*args, **kwargs)
+        stages[name] = dict(peak_mb=(tracemalloc.get_traced_memory()[1]-base)/1024**2)
+    else:
+        t0 = time.perf_counter()
+        out = func(*args, **kwargs)
+        stages[name] = dict(seconds=time.perf_counter()-t0)
+    return out
+
+
+def run_stages(image_name, width, half_tile, edge_detection, seed=0):
+    pipeline = MosaicPipeline(MosaicConfig(half_tile=half_tile, edge_detection=edge_detection, width=width, seed=seed))
+    c = pipeline.config
+    stages = {}
+    random.seed(seed)
+    img0 = pipeline.load(getattr(sk.data, image_name)())
+    h,w = img0.shape[0],img0.shape[1]
+    img_edges = measure(stages, 'edges', pipeline.find_edges, img0)
+    chains, angles_0to180 = measure(stages, 'chains_and_angles', guides.chains_and_angles, img_edges, half_tile)
+    polygons = measure(stages, 'place_tiles_along_chains', pipeline.place_tiles_along_chains, chains, angles_0to180)
+    polygons = measure(stages, 'place_tiles_into_gaps', pipeline.fill_gaps, polygons, h, w)
+    polygons = measure(stages, 'make_convex', convex.make_convex, polygons, half_tile, c.A0)
+    polygons = measure(stages, 'post_process', tiles.post_process, polygons, half_tile, c.A0)
+    colors = measure(stages, 'coloring', coloring.colors_from_original, polygons, img0,
+                     method=c.color_method, statistic=c.color_statistic)
+    measure(stages, 'rendering', render.render_image, polygons, colors, h, w)
+    return dict(image=image_name, width=w, height=h, half_tile=half_tile, tiles=len(polygons), stages=stages)
+
+
+def run_case(image_name, width, half_tile, edge_detection, seed=0, memory=True):
+    # timing pass, then (same seed => same tiles) memory pass with tracemalloc
+    run = run_stages(image_name, width, half_tile, edge_detection, seed)
+    run['seconds'] = sum(s['seconds'] for s in run['stages'].values())
+    if memory:
+        tracemalloc.start()
+        try:
+            stages = run_stages(image_name, width, half_tile, edge_detection, seed)['stages']
+        finally:
+            tracemalloc.stop()
+        for name,s in stages.items():
+            run['stages'][name].update(s)
+    return run
+
+
+def case_key(run):
+    return (run['image'], run['width'], run['half_tile'])
+
+
+def compare(results, baseline, tolerance):
+    # returns list of (case, stage, seconds, baseline seconds) which are slower than tolerance allows
+    base_runs = {case_key(run):run for run in baseline['runs']}
+    regressions = []
+    for run in results['runs']:
+        base = base_runs.get(case_key(run))
+        if base is None or 'stages' not in run or 'stages' not in base: # failed cases
+            continue
+        for stage,s in run['stages'].items():
+            s0 = base['stages'].get(stage)
+            if s0 and s['seconds'] > (1+tolerance)*s0['seconds'] and s['seconds']-s0['seconds'] > 0.05:
+                regressions += [(case_key(run), stage, s['seconds'], s0['seconds'])]
+        print (f'{run["image"]} w={run["width"]} half_tile={run["half_tile"]}:',
+               f'{run["seconds"]:.1f}s (baseline {base["seconds"]:.1f}s),',
+               f'{run["tiles"]} tiles (baseline {base["tiles"]})')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of all stages of the mosaic pipeline.')
+    parser.add_argument('--images', nargs='*', default=IMAGES, help='names of scikit-image test images')
+    parser.add_argument('--widths', nargs='*', type=int, default=WIDTHS)
+    parser.add_argument('--half-tiles', nargs='*', type=int, default=HALF_TILES)
+    parser.add_argument('--edge-detection', choices=['HED', 'DiBlasi'], default=default_edge_detection())
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', default='', help='baseline json file')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the second pass which measures peak memory')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='accepted slowdown compared to baseline (0.2 => 20%%)')
+    args = parser.parse_args(argv)
+
+    results = dict(meta=dict(python=platform.python_version(), platform=platform.platform(),
+                             numpy=np.__version__, scipy=scipy.__version__, shapely=shapely.__version__,
+                             skimage=sk.__version__, edge_detection=args.edge_detection,
+                             date=time.strftime('%Y-%m-%d %H:%M:%S')),
+                   runs=[])
+    for image_name in args.images:
+        for width in args.widths:
+            for half_tile in args.half_tiles:
+                try:
+                    run = run_case(image_name, width, half_tile, args.edge_detection, memory=args.memory)
+                    print (f'{image_name} w={width} half_tile={half_tile}: {run["seconds"]:.1f}s, {run["tiles"]} tiles')
+                except Exception as e: # record failure and continue with the next case
+                    run = dict(image=image_name, width=width, half_tile=half_tile, error=repr(e),
+                               traceback=traceback.format_exc())
+                    print (f'{image_name} w={width} half_tile={half_tile}: failed, {e!r}')
+                results['runs'] += [run]
+                with open(args.output, 'w') as fn: # save after each case
+                    json.dump(results, fn, indent=1)
+
+    if args.compare:
+        with open(args.compare) as fn:
+            baseline = json.load(fn)
+        regressions = compare(results, baseline, args.tolerance)
+        for case,stage,seconds,seconds0 in regressions:
+            print (f'! slower: {case} {stage}: {seconds:.2f}s instead of {seconds0:.2f}s')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
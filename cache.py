@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache for expensive stages of the mosaic pipeline
+=======================================================================
+Results are stored as *.npz files which are named by a hash of the input image
+and all parameters the stage depends on (including the results of earlier stages).
+Least recently used files are removed when the cache grows beyond max_bytes.
+"""
+
+import hashlib
+import os
+import random
+import tempfile
+from pathlib import Path
+import numpy as np
+from shapely import wkb
+import metrics
+
+
+def image_hash(img):
+    h = hashlib.sha256()
+    h.update(str((img.shape, img.dtype.str)).encode())
+    h.update(np.ascontiguousarray(img).tobytes())
+    return h.hexdigest()
+
+
+_file_hashes = {} # (path, size, time of last change) => hash of the content
+
+def file_hash(fname, chunk_size=2**20):
+    # hash of the file content => same key for copies of an image under other names
+    # (calculated once per path and version of the file)
+    path = Path(fname).resolve()
+    stat = path.stat()
+    version = (str(path), stat.st_size, stat.st_mtime_ns)
+    if version not in _file_hashes:
+        h = hashlib.sha256()
+        with open(path, 'rb') as fn:
+            for chunk in iter(lambda: fn.read(chunk_size), b''):
+                h.update(chunk)
+        _file_hashes[version] = h.hexdigest()
+    return _file_hashes[version]
+
+
+def random_state_hash():
+    # identifies the current state of the random module
+    return hashlib.sha256(repr(random.getstate()).encode()).hexdigest()
+
+
+def stage_hash(stage, parent, params):
+    # parent: hash of the input (image hash or key of the previous stage)
+    h = hashlib.sha256()
+    h.update(repr((stage, parent, sorted(params.items()))).encode())
+    return h.hexdigest()
+
+
+# conversion of stage results into flat arrays and back:
+def encode(kind, value, name):
+    if kind == 'array':
+        return {name: np.asarray(value)}
+    if kind == 'chains': # list of chains (lists of [x,y])
+        lengths = [len(chain) for chain in value]
+        points = np.array([xy for chain in value for xy in chain], dtype=np.int32).reshape((-1,2))
+        return {name+'_points': points, name+'_offsets': np.cumsum([0]+lengths)}
+    if kind == 'polygons': # list of shapely polygons => WKB
+        blobs = [p.wkb for p in value]
+        data = np.frombuffer(b''.join(blobs), dtype=np.uint8)
+        return {name+'_wkb': data, name+'_offsets': np.cumsum([0]+[len(b) for b in blobs])}
+    raise ValueError('Kind of stage result not understood.')
+
+
+def decode(kind, arrays, name):
+    if kind == 'array':
+        return arrays[name]
+    if kind == 'chains':
+        points, offsets = arrays[name+'_points'], arrays[name+'_offsets']
+        return [points[i0:i1].tolist() for i0,i1 in zip(offsets[:-1], offsets[1:])]
+    if kind == 'polygons':
+        data, offsets = arrays[name+'_wkb'].tobytes(), arrays[name+'_offsets']
+        return [wkb.loads(data[i0:i1]) for i0,i1 in zip(offsets[:-1], offsets[1:])]
+    raise ValueError('Kind of stage result not understood.')
+
+
+class StageCache(object):
+    # path=None => caching switched off (all stages are calculated)
+
+    def __init__(self, path=None, max_bytes=2*1024**3):
+        self.path = Path(path) if path else None
+        self.max_bytes = max_bytes
+        if self.path:
+            self.path.mkdir(parents=True, exist_ok=True)
+
+    def __call__(self, stage, parent, params, kinds, compute, keep_random_state=False):
+        # kinds: kind of each returned value ('array', 'chains' or 'polygons'),
+        #        a single string if compute() returns only one value
+        # keep_random_state: stage uses the random module => restore its state on cache hits
+        #                    (later stages get the same random numbers as without cache)
+        # returns key of this stage (=> parent of the next stage) and the result
+        key = stage_hash(stage, parent, params)
+        single = isinstance(kinds, str)
+        kinds = [kinds] if single else kinds
+        values = self.load(key, kinds)
+        if values is None:
+            values = compute()
+            values = [values] if single else values
+            self.save(key, kinds, values)
+        else:
+            metrics.note('cached', True)
+            if keep_random_state:
+                random.setstate(self._random_state)
+        return key, values[0] if single else tuple(values)
+
+    def _file(self, key):
+        return self.path / f'{key}.npz'
+
+    def load(self, key, kinds):
+        if not self.path:
+            return None
+        try: # file may be removed by another process at any time
+            with np.load(self._file(key)) as arrays:
+                values = [decode(kind, arrays, f'v{i}') for i,kind in enumerate(kinds)]
+                state = arrays['random_state']
+            os.utime(self._file(key)) # => recently used
+        except FileNotFoundError:
+            return None
+        self._random_state = (int(state[0]), tuple(int(s) for s in state[1:]), None)
+        return values
+
+    def save(self, key, kinds, values):
+        if not self.path:
+            return
+        arrays = {}
+        for i,(kind,value) in enumerate(zip(kinds, values)):
+            arrays.update(encode(kind, value, f'v{i}'))
+        version, state, _ = random.getstate()
+        arrays['random_state'] = np.array((version,)+state, dtype=np.int64)
+        # unique temporary file => several processes can share the cache directory
+        with tempfile.NamedTemporaryFile(dir=self.path, prefix=key, suffix='.tmp', delete=False) as fn:
+            try:
+                np.savez_compressed(fn, **arrays)
+            except BaseException:
+                fn.close()
+                os.unlink(fn.name)
+                raise
+        os.replace(fn.name, self._file(key))
+        self.evict()
+
+    def evict(self):
+        # remove least recently used results until the size limit is reached
+        # (temporary files *.tmp are not touched, files may vanish due to other processes)
+        files = []
+        for f in self.path.glob('*.npz'):
+            try:
+                stat = f.stat()
+            except FileNotFoundError:
+                continue
+            files += [(stat.st_mtime, stat.st_size, f)]
+        files.sort()
+        size = sum(f_size for _,f_size,_ in files)
+        for _,f_size,f in files[:-1]: # keep at least the newest result
+            if size <= self.max_bytes:
+                break
+            size -= f_size
+            try:
+                f.unlink()
+            except FileNotFoundError:
+                pass
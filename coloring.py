@@ -10,9 +10,17 @@ from pathlib import Path
 import numpy as np
 from skimage import io
 from skimage import draw
+from skimage import color
+from scipy.spatial import cKDTree
+import raster
 
 
-def colors_from_original(polygons, original_image, method='average'):
+def colors_from_original(polygons, original_image, method='average', statistic='mean'):
+    # method: 'point', 'average' (bounding box of each tile) or
+    #         'masked' (only pixels inside each tile, all tiles at once => fast)
+    # statistic: 'mean', 'median' or 'dominant' (only for method='masked')
+    if method == 'masked':
+        return masked_colors(polygons, original_image, statistic)
     colors = []
     for j,p in enumerate(polygons): 
 
@@ -39,28 +47,115 @@ def colors_from_original(polygons, original_image, method='average'):
     return colors
 
 
-
-def modify_colors(colors, variant, colors_collection=[]):
-    def nearest_color( subjects, query ):
-        # https://stackoverflow.com/questions/34366981/python-pil-finding-nearest-color-rounding-colors
-        return min( subjects, key = lambda subject: sum( (s - q) ** 2 for s, q in zip( subject, query ) ) )
-    #nearest_color( ((1, 1, 1, "white"), (1, 0, 0, "red"),), (64/255,0,0) ) # example
-    new_colors = []
-    for c in colors:
-        if variant == 'monochrome':
-            c_new = nearest_color(((1,1,1),(0,0,0)), c) # monochrom
-        elif variant == 'grayscale':
-            c_new = str(.2989 * c[0] + 0.5870*c[1] + 0.1140*c[2]) # matplotlib excepts grayscale be strings
-        elif variant == 'polychrome':
-            n = 9
-            some_gray = [(g/n,g/n,g/n) for g in range(n+1)]
-            c_new = nearest_color(some_gray, c) # monochrom            
-        elif variant == 'source':
-            c_new = nearest_color(colors_collection/255, c)
-        else:
-            raise ValueError('Parameter not understood.')
-        new_colors += [c_new]
-    return new_colors
+def masked_colors(polygons, original_image, statistic='mean'):
+    # rasterize all tiles into one label image and reduce the pixels of each label
+    h,w = original_image.shape[0],original_image.shape[1]
+    n = len(polygons)+1 # label 0 => background
+    labels = raster.label_image(polygons, h, w).ravel()
+    pixels = original_image[:,:,:3].reshape((-1,3))
+    counts = np.bincount(labels, minlength=n)
+
+    if statistic == 'mean':
+        colors = np.stack([np.bincount(labels, weights=pixels[:,ch], minlength=n) for ch in range(3)], axis=1)
+        colors = colors/np.maximum(counts, 1)[:,None]
+    elif statistic == 'median':
+        starts = np.cumsum(counts)-counts
+        i_low, i_high = starts+np.maximum(counts-1, 0)//2, starts+counts//2
+        colors = np.zeros((n,3))
+        for ch in range(3):
+            values = pixels[np.lexsort((pixels[:,ch], labels)), ch].astype(float) # sorted by label, then value (no uint8 overflow)
+            colors[:,ch] = (values[np.minimum(i_low, len(values)-1)]+values[np.minimum(i_high, len(values)-1)])/2
+    elif statistic == 'dominant':
+        # most frequent color (8 levels per channel), averaged inside of this color bin
+        bins = (pixels//32).astype(np.int64) @ np.array([64,8,1])
+        keys, inverse, key_counts = np.unique(labels.astype(np.int64)*512+bins, return_inverse=True, return_counts=True)
+        key_labels = keys//512
+        order = np.lexsort((key_counts, key_labels)) # last entry of each label => largest count
+        last = np.r_[key_labels[order][1:] != key_labels[order][:-1], True]
+        colors = np.zeros((n,3))
+        for ch in range(3):
+            sums = np.bincount(inverse.ravel(), weights=pixels[:,ch], minlength=len(keys))
+            colors[key_labels[order][last],ch] = sums[order][last]/key_counts[order][last]
+    else:
+        raise ValueError('Parameter not understood.')
+
+    colors = colors[1:]/255
+    # very small tiles without any pixel: color at a point inside
+    for i in np.flatnonzero(counts[1:]==0):
+        x,y = np.array(polygons[i].representative_point().coords[0]).astype(int)
+        colors[i] = original_image[min(max(y,0),h-1), min(max(x,0),w-1), :3]/255
+    return list(colors)
+
+
+
+_palette_cache = {} # converted palettes (and KD-trees for large palettes)
+
+def _to_space(colors, space):
+    colors = np.asarray(colors, dtype=float).reshape((-1,3))
+    if space == 'rgb':
+        return colors
+    if space == 'lab': # perceptually uniform color space
+        return color.rgb2lab(np.clip(colors, 0, 1)[:,None,:])[:,0,:]
+    raise ValueError('Parameter not understood.')
+
+
+def _prepared_palette(palette, space):
+    palette = np.asarray(palette, dtype=float).reshape((-1,3))
+    key = (palette.tobytes(), space)
+    if key not in _palette_cache:
+        palette_space = _to_space(palette, space)
+        tree = cKDTree(palette_space) if len(palette) > 64 else None
+        _palette_cache[key] = (palette_space, tree)
+    return _palette_cache[key]
+
+
+def _nearest(colors_space, palette_space, tree, chunk_size=100000):
+    if tree is not None:
+        return tree.query(colors_space)[1]
+    indices = np.zeros(len(colors_space), dtype=int)
+    for i0 in range(0, len(colors_space), chunk_size): # distance matrix in chunks => limited memory
+        diff = colors_space[i0:i0+chunk_size,None,:]-palette_space[None,:,:]
+        indices[i0:i0+chunk_size] = np.argmin((diff**2).sum(axis=2), axis=1)
+    return indices
+
+
+def nearest_palette_indices(colors, palette, space='rgb'):
+    # index of the nearest palette color for each color (all colors in 0...1)
+    # space: 'rgb' or 'lab' (CIELAB => perceptually correct)
+    return _nearest(_to_space(colors, space), *_prepared_palette(palette, space))
+
+
+def map_to_palettes(colors, palettes, space='rgb'):
+    # palettes: dict name => palette (as in load_colors, values 0...255)
+    # returns dict name => index of the nearest palette color for each color
+    colors_space = _to_space(colors, space) # converted only once
+    return {name: _nearest(colors_space, *_prepared_palette(np.asarray(palette)/255, space))
+            for name,palette in palettes.items()}
+
+
+def modify_colors(colors, variant, colors_collection=[], space='rgb', return_indices=False):
+    # variant: 'monochrome', 'grayscale', 'polychrome' or 'source' (=> colors_collection, values 0...255)
+    # return_indices: return index of the palette color instead of the color itself
+    #                 (not possible for 'grayscale' which has no palette)
+    if variant == 'grayscale':
+        if return_indices:
+            raise ValueError('Grayscale colors have no palette indices.')
+        return [str(.2989 * c[0] + 0.5870*c[1] + 0.1140*c[2]) for c in colors] # matplotlib excepts grayscale be strings
+    elif variant == 'monochrome':
+        palette = np.array([(1,1,1),(0,0,0)], dtype=float) # monochrom
+    elif variant == 'polychrome':
+        n = 9
+        palette = np.array([(g/n,g/n,g/n) for g in range(n+1)]) # some gray
+    elif variant == 'source':
+        palette = np.asarray(colors_collection)/255
+    else:
+        raise ValueError('Parameter not understood.')
+    if len(colors) == 0:
+        return []
+    indices = nearest_palette_indices(colors, palette, space)
+    if return_indices:
+        return indices
+    return list(palette[indices])
 
 
 def load_colors():
@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import os
+import heapq
+from multiprocessing import Pool, current_process
 import numpy as np
-import time
+import shapely
 from shapely.geometry import LineString, Polygon, MultiPoint#,Point
 from shapely import affinity
+import metrics
 
 
 def fit_in_polygon(p, nearby_polygons):
@@ -12,10 +16,10 @@ def fit_in_polygon(p, nearby_polygons):
         p = p.difference(p_vorhanden)
     # only keep largest part if polygon consists of multiple fragments:
     if p.geom_type=='MultiPolygon':
-        i_largest = np.argmax([p_i.area for p_i in p])
-        p = p[i_largest]
+        i_largest = np.argmax([p_i.area for p_i in p.geoms])
+        p = p.geoms[i_largest]
     # remove pathologic polygons with holes (rare event):
-    if p.type not in ['MultiLineString','LineString', 'GeometryCollection']:
+    if p.geom_type not in ['MultiLineString','LineString', 'GeometryCollection']:
         if p.interiors: # check for attribute interiors if accessible
             p = Polygon(list(p.exterior.coords))
     return p
@@ -25,24 +29,51 @@ def my_simplify(p, accepted_loss=0.05): # concave->convex
     # Prüfen, ob das Polygon durch Weglassen einer Ecke (oder von mehr als einer), 
     # immer noch ähnlich aussieht (d.h. Flächeninhalt nur minimal kleiner, keinesfalls größer!)
     # => besonders nützlich, um "fiese Spitzen" bei konkaven Polygonen zu entfernen
-    while True:
-        ecken = list(p.exterior.coords)[:-1] # remove last coordinate (is only repeated from first)
-        A0 = Polygon(ecken).area
-        erfolg = False
-        for i in range(len(ecken)):
-            ecken_neu = ecken[:i]+ecken[i+1:] # remove a corner
-            if len(ecken)<=3: break # must be at leat a triangle
-            p_neu = Polygon(ecken_neu)
-            if p_neu.area <= A0 and A0-p_neu.area < accepted_loss*A0 and p_neu.area>0.05*A0 and p_neu.is_valid:
-                p = p_neu # besseres Polygon
-                erfolg = True
-                break
-        if len(ecken)<3: erfolg=False # must be at leat a triangle
-        if p.geom_type!='Polygon': erfolg=False
-        if erfolg == False: break
-    return p
+    # Visvalingam: the corner with the smallest loss of area (triangle with its neighbours) is removed first,
+    # losses are kept in a heap and only updated for the neighbours of a removed corner
+    ecken = np.asarray(p.exterior.coords)[:-1] # remove last coordinate (is only repeated from first)
+    n = len(ecken)
+    if n <= 3: # must be at least a triangle
+        return p
+    prev, nxt = list(range(-1, n-1)), list(range(1, n+1))
+    prev[0], nxt[-1] = n-1, 0
+    x, y = ecken[:,0], ecken[:,1]
+    A = (np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y))/2
+    sign = 1 if A >= 0 else -1 # orientation => convex corners have positive loss
+    A = abs(A)
+
+    def loss(i): # area lost by removing corner i (negative => polygon would grow)
+        (x0,y0),(x1,y1),(x2,y2) = ecken[prev[i]], ecken[i], ecken[nxt[i]]
+        return sign*((x1-x0)*(y2-y0) - (x2-x0)*(y1-y0))/2
+
+    version = [0]*n # outdated entries of the heap are skipped
+    heap = [(loss(i), i, 0) for i in range(n)]
+    heapq.heapify(heap)
+    removed = np.zeros(n, dtype=bool)
+    n_left = n
+    while heap and n_left > 3:
+        d, i, v = heapq.heappop(heap)
+        if removed[i] or v != version[i] or d < 0: # (concave corners come back when a neighbour is removed)
+            continue
+        if d >= accepted_loss*A or A-d <= 0.05*A: # smallest loss too large => done
+            break
+        removed[i] = True
+        metrics.count_geos(2) # polygon, is_valid
+        if not Polygon(ecken[~removed]).is_valid: # new edge crosses others
+            removed[i] = False
+            continue
+        nxt[prev[i]], prev[nxt[i]] = nxt[i], prev[i]
+        A -= d
+        n_left -= 1
+        for j in (prev[i], nxt[i]):
+            version[j] += 1
+            heapq.heappush(heap, (loss(j), j, version[j]))
+    if n_left == n:
+        return p
+    return Polygon(ecken[~removed])
 
 def is_convex(p):
+    metrics.count_geos(3) # convex hull, 2 areas
     if p.convex_hull.area > 1.01 * p.area:
         return False
     else:
@@ -58,17 +89,18 @@ def simple_concave_zu_convex(p, half_tile, A0, richtung=-1):
         counter += 1
         p = concave_list.pop()
         p_points = MultiPoint(p.exterior.coords)
-        concave_points = [i for i,point in enumerate(p_points) if p.convex_hull.contains(point)]
+        concave_points = [i for i,point in enumerate(p_points.geoms) if p.convex_hull.contains(point)]
         # does not find points when polygon has hole (i.e. has interiors)
         if len(concave_points) == 0:
-            print ('Could not convert tile to convex. Should not happen :-(')
+            metrics.add('not_convertible') # should not happen :-(
             return False, []
         i_krit = concave_points[0]
-        xa,ya = p_points[i_krit].coords[0]
-        xb,yb = p_points[i_krit+richtung].coords[0] # -1 or +1 can be used
+        xa,ya = p_points.geoms[i_krit].coords[0]
+        xb,yb = p_points.geoms[i_krit+richtung].coords[0] # -1 or +1 can be used
         angle_of_cut_line = np.arctan2(xa-xb, ya-yb)*180/np.pi
         cut_line = LineString([(xa,ya-half_tile*4),(xa,yb+half_tile*4)])
-        cut_line = affinity.rotate(cut_line, -angle_of_cut_line, origin=p_points[i_krit])
+        cut_line = affinity.rotate(cut_line, -angle_of_cut_line, origin=p_points.geoms[i_krit])
+        metrics.count_geos(len(p.exterior.coords)+4) # contains, rotate, buffer, difference
         try:
             pp = p.difference(cut_line.buffer(0.2)) # remark: shapely.split() is not useful
         except: # rarely: TopologicalError: This operation could not be performed. Reason: unknown
@@ -80,7 +112,7 @@ def simple_concave_zu_convex(p, half_tile, A0, richtung=-1):
         if counter>5:
             success = False
             break
-        for ppi in pp:
+        for ppi in pp.geoms:
             if ppi.is_valid == False or ppi.area<0.05*A0:
                 continue
             if not is_convex(ppi):
@@ -91,53 +123,69 @@ def simple_concave_zu_convex(p, half_tile, A0, richtung=-1):
 
 
 
-def make_convex(polygons, half_tile, A0):
-    t0 = time.time()
-    still_concave = []
-    polygons_convex = []
-    counter = 0
-    for j,p in enumerate(polygons):
-        if is_convex(p):
-            polygons_convex += [p] # ideal case
-            counter += 1
+LADDER = [(0, -1, 'cut'), (0.1, +1, 'cut_reversed'), (0.5, +1, 'cut_buffered'), (0.5, -1, 'cut_buffered_reversed')]
+# attempts to split a concave tile: buffer, direction of the cut, name of the path
+PATHS = ['simplified'] + [path for d,richtung,path in LADDER] + ['simplified_more', 'still_concave']
+
+
+def convex_mask(polygons):
+    # is_convex of all tiles at once
+    if hasattr(shapely, 'convex_hull') and len(polygons): # shapely >= 2.0
+        ps = np.array(polygons, dtype=object)
+        metrics.count_geos(3*len(ps)) # convex hulls, 2 areas
+        return ~(shapely.area(shapely.convex_hull(ps)) > 1.01*shapely.area(ps))
+    return np.array([is_convex(p) for p in polygons], dtype=bool)
+
+
+def repair_concave(p, half_tile, A0):
+    # concave tile => name of the path which worked (see PATHS) and resulting tiles
+    p = my_simplify(p)
+    if is_convex(p):
+        return 'simplified', [p]
+    buffered = {0: p} # (each buffer only once)
+    for d,richtung,path in LADDER: # first success ends the ladder
+        if d not in buffered:
+            buffered[d] = p.buffer(d)
+        success, convex_list = simple_concave_zu_convex(buffered[d], half_tile, A0, richtung=richtung)
+        if success:
+            return path, convex_list
+    accepted_loss = 0.05 # default
+    while is_convex(p)==False and accepted_loss<0.8:
+        accepted_loss += 0.05
+        p = my_simplify(p, accepted_loss)
+    if is_convex(p):
+        return 'simplified_more', [p]
+    return 'still_concave', [] # dropped
+
+
+def _repair_chunk(task):
+    concave, half_tile, A0 = task
+    return [repair_concave(p, half_tile, A0) for p in concave]
+
+
+def make_convex(polygons, half_tile, A0, processes=1, chunk_size=64):
+    # processes: worker processes for the repair of concave tiles (None => all cores)
+    # (GEOS operations inside of the worker processes are not counted)
+    processes = processes or os.cpu_count()
+    with metrics.stage('make_convex', n_in=len(polygons)) as record:
+        record.update({path:0 for path in PATHS}) # number of tiles per path
+        convex = convex_mask(polygons)
+        concave = [p for p,c in zip(polygons, convex) if not c]
+        if processes > 1 and len(concave) > chunk_size and not current_process().daemon:
+            tasks = [(concave[i:i+chunk_size], half_tile, A0) for i in range(0, len(concave), chunk_size)]
+            with Pool(processes) as pool:
+                repaired = [r for chunk in pool.map(_repair_chunk, tasks) for r in chunk]
         else:
-            p = my_simplify(p)
-            if is_convex(p):
-                polygons_convex += [p]
+            repaired = [repair_concave(p, half_tile, A0) for p in concave]
+
+        polygons_convex = []
+        repaired = iter(repaired)
+        for p,c in zip(polygons, convex): # same order as before
+            if c:
+                polygons_convex += [p] # ideal case
             else:
-                success, convex_list = simple_concave_zu_convex(p, half_tile, A0, richtung=-1)
-                if not success:
-                    # second chance with other cutting direction:
-                    success, convex_list = simple_concave_zu_convex(p.buffer(0.1), half_tile, A0, richtung=+1)
-                # and again, but buffered this time
-                if not success:
-                    success, convex_list = simple_concave_zu_convex(p.buffer(0.5), half_tile, A0, richtung=+1)
-                if not success:
-                    success, convex_list = simple_concave_zu_convex(p.buffer(0.5), half_tile, A0, richtung=-1)
-                if success:
-                    for kp in convex_list:
-                        polygons_convex += [kp]
-
-                else:
-                    accepted_loss = 0.05 # default
-                    while is_convex(p)==False and accepted_loss<0.8:
-                        accepted_loss += 0.05
-                        p = my_simplify(p, accepted_loss)
-                    if is_convex(p):
-                        polygons_convex += [p]
-                    else:
-                        still_concave += [p]
-
-    if still_concave:
-        print (f'! {len(still_concave)} tiles are still concave')    
-    print (f'{len(polygons)-counter} tiles converted to convex', f'{time.time()-t0:.1f}s')    
+                path, convex_list = next(repaired)
+                metrics.add(path)
+                polygons_convex += convex_list
+        record.update(converted=len(concave), n_out=len(polygons_convex))
     return polygons_convex
-
-
-
-
-
-
-
-
-
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stages of the pipeline as a dependency graph with memoized results
+=======================================================================
+Each stage declares the stages (or sources, e.g. the image) it uses and the
+config parameters it depends on. Its signature is a hash of these parameters
+and the signatures of its inputs, i.e. it changes exactly when the stage or
+anything upstream of it has to be calculated again. The latest result of
+each stage is kept in memory, so after changing a parameter only the stages
+downstream of it are executed.
+
+    graph = StageGraph()
+    graph.add('edges', find_edges, inputs=['image'], params=['gauss'])
+    graph.add('chains', find_chains, inputs=['edges'], params=['half_tile'])
+    values = graph.run(config, sources=dict(image=(image_signature, image)))
+
+Stages are executed in the order they were added. Stages which draw random
+numbers are added with uses_random=True: the state of the random module they
+start from is part of their signature, and the state after the stage is
+memoized as well => a reused stage leaves the same random state behind as if
+it had been executed. Other stages neither depend on nor change it.
+With run(..., keep=[...]) nothing is memoized and every other result is
+freed as soon as the last stage using it is done (low memory).
+"""
+
+import random
+import cache
+import metrics
+
+
+class StageGraph(object):
+
+    def __init__(self):
+        self.stages = {} # name => (function, inputs, params, kinds, uses_random)
+        self.memo = {} # name => (signature, result, random state after the stage)
+
+    def add(self, name, func, inputs=(), params=(), kinds=None, uses_random=False):
+        # func: gets the results of the inputs (in this order) and returns the result of the stage
+        # inputs: names of earlier stages or of sources
+        # params: names of config attributes the stage depends on
+        # kinds: kind of the result for the on-disk cache (see cache.encode), None => not stored on disk,
+        #        or function which gets the config and returns the kinds
+        # uses_random: stage draws numbers from the random module
+        self.stages[name] = (func, list(inputs), list(params), kinds, uses_random)
+
+    def _parent_and_params(self, name, config, signatures):
+        func, inputs, params, kinds, uses_random = self.stages[name]
+        parent = signatures[inputs[0]] if len(inputs) == 1 else tuple(signatures[i] for i in inputs)
+        params = {p:getattr(config, p) for p in params}
+        if uses_random: # e.g. another seed => another result
+            params['random_state'] = cache.random_state_hash()
+        return parent, params
+
+    def last_use(self):
+        # name of a stage or source => name of the last stage which uses it
+        last = {}
+        for name,(func, inputs, params, kinds, uses_random) in self.stages.items():
+            last.update({i:name for i in inputs})
+        return last
+
+    def run(self, config, sources, store=None, keep=None):
+        # sources: dict name => (signature, value) of all inputs which are no stages
+        # store: cache.StageCache for stages with kinds (results on disk, e.g. shared between runs)
+        # keep: names of the results to return, None => all (and all stages are memoized)
+        # returns dict name => result of all stages (and sources), or only of keep
+        signatures = {name:s for name,(s,value) in sources.items()}
+        values = {name:value for name,(s,value) in sources.items()}
+        last = self.last_use()
+        for name,(func, inputs, params, kinds, uses_random) in self.stages.items():
+            parent, param_values = self._parent_and_params(name, config, signatures)
+            signature = signatures[name] = cache.stage_hash(name, parent, param_values)
+            args = [values[i] for i in inputs]
+            if keep is not None: # free inputs after their last stage (args is the only reference left)
+                for i in set(inputs):
+                    if last[i] == name and i not in keep:
+                        del values[i]
+            with metrics.stage(name) as record:
+                memo = self.memo.get(name)
+                if memo is not None and memo[0] == signature:
+                    values[name] = memo[1]
+                    if uses_random:
+                        random.setstate(memo[2])
+                    record['memoized'] = True
+                    continue
+                if callable(kinds):
+                    kinds = kinds(config)
+                if kinds is not None and store is not None:
+                    _, values[name] = store(name, parent, param_values, kinds, lambda: func(*args),
+                                            keep_random_state=uses_random) # key of the store = signature
+                else:
+                    values[name] = func(*args)
+                if keep is None:
+                    self.memo[name] = (signature, values[name], random.getstate() if uses_random else None)
+            del args
+        return values if keep is None else {name:values[name] for name in keep}
+
+    def clear(self):
+        # forget all memoized results (e.g. to free memory)
+        self.memo = {}
@@ -7,15 +7,31 @@ from skimage.io import imread
 from skimage import filters
 from skimage import transform
 import plotting
+import metrics
 from pathlib import Path
+import threading
+import inspect
 
+# filters of color images: channel_axis since scikit-image 0.19, multichannel before (removed in 0.21)
+RGB = dict(channel_axis=-1) if 'channel_axis' in inspect.signature(filters.gaussian).parameters else dict(multichannel=True)
 
-def load_image(fname, width=900, plot=[]):
+
+def load_image(fname, width=900, plot=[], dtype=int):
     
     if fname:
+        if width is None: # native resolution => allow very large images
+            from PIL import Image
+            Image.MAX_IMAGE_PIXELS = None
         img0 = imread(fname)
     else:
         img0 = sk.data.coffee() # coffee (example image)
+    return prepare_image(img0, width, plot, dtype)
+
+
+def prepare_image(img0, width=900, plot=[], dtype=int):
+    # width=None => keep native resolution
+    # dtype: of the returned image (values 0...255), e.g. np.uint8 for large images
+    #        (np.uint8 => resized channel by channel, no float64 copy of the whole image)
     
     # ensure image is rgb (for consistency)
     if len(img0.shape)<3:
@@ -24,19 +40,29 @@ def load_image(fname, width=900, plot=[]):
     # resize to same image width => tile size has always similar effect
     if width is not None:
         factor = width/img0.shape[1]
-        img0 = transform.resize(img0, (int(img0.shape[0]*factor), int(img0.shape[1]*factor)), anti_aliasing=True) 
-    img0 = (img0*255).astype(int)
+        size = (int(img0.shape[0]*factor), int(img0.shape[1]*factor))
+        if dtype == np.uint8: # (same result)
+            resized = np.zeros(size+img0.shape[2:], dtype=dtype)
+            for c in range(img0.shape[2]):
+                resized[:,:,c] = transform.resize(img0[:,:,c], size, anti_aliasing=True)*255
+            img0 = resized
+        else:
+            img0 = transform.resize(img0, size, anti_aliasing=True) 
+            img0 = (img0*255).astype(dtype)
+    else:
+        img0 = sk.util.img_as_ubyte(img0).astype(dtype, copy=False)
     if 'original' in plot: plotting.plot_image(img0)
-    print (f'Size of input image: {img0.shape[0]}px * {img0.shape[1]}px')
+    metrics.note('size', f'{img0.shape[0]}px * {img0.shape[1]}px') # size of input image
     
     return img0
 
 
 
-def edges_diblasi(img, gauss=5, details=1, plot=[]):
+def edges_diblasi(img, gauss=5, details=1, plot=[], dtype=np.float64):
+    # dtype: of the interim images (np.float32 => half the memory, edges differ in very few pixels)
 
     # RGB to gray ("Luminance channel" in Di Blasi)
-    img_gray = sk.color.rgb2gray(img)
+    img_gray = sk.color.rgb2gray(img if dtype == np.float64 else sk.util.img_as_float32(img))
     
     # equalize histogram
     img_eq = sk.exposure.equalize_hist(img_gray)
@@ -46,7 +72,7 @@ def edges_diblasi(img, gauss=5, details=1, plot=[]):
     
     # segment bright areas to blobs
     variance = img_gauss.std()**2 #  evtl. direkt die std verwenden
-    img_seg = np.ones((img.shape[0],img.shape[1]))        
+    img_seg = np.ones((img.shape[0],img.shape[1]), dtype=dtype)        
     threshold = variance/4*2*details
     img_seg[abs(img_gauss-img_gauss.mean())>threshold] = 0
     
@@ -60,64 +86,157 @@ def edges_diblasi(img, gauss=5, details=1, plot=[]):
 
 
 
-def hed_edges(image):
-    import cv2 as cv
+class CropLayer(object):
     # based on https://github.com/opencv/opencv/blob/master/samples/dnn/edge_detection.py
-    class CropLayer(object):
-        def __init__(self, params, blobs):
-            self.xstart = 0
-            self.xend = 0
-            self.ystart = 0
-            self.yend = 0
-        # Our layer receives two inputs. We need to crop the first input blob
-        # to match a shape of the second one (keeping batch size and number of channels)
-        def getMemoryShapes(self, inputs):
-            inputShape, targetShape = inputs[0], inputs[1]
-            batchSize, numChannels = inputShape[0], inputShape[1]
-            height, width = targetShape[2], targetShape[3]
-            self.ystart = int((inputShape[2] - targetShape[2]) / 2)
-            self.xstart = int((inputShape[3] - targetShape[3]) / 2)
-            self.yend = self.ystart + height
-            self.xend = self.xstart + width
-            return [[batchSize, numChannels, height, width]]
-        def forward(self, inputs):
-            return [inputs[0][:,:,self.ystart:self.yend,self.xstart:self.xend]]
-    
-    # Load the pretrained model (source: https://github.com/s9xie/hed)
-    script_path = Path(__file__).parent.absolute()
-    hed_path = Path.joinpath(script_path, 'HED')
-    net = cv.dnn.readNetFromCaffe(str(hed_path / 'deploy.prototxt'),
-                                  str(hed_path / 'hed_pretrained_bsds.caffemodel') )
-    cv.dnn_registerLayer('Crop', CropLayer)
-
-    image=cv.resize(image,(image.shape[1],image.shape[0]))
-    # prepare image as input dataset (mean values from full image dataset)
-    inp = cv.dnn.blobFromImage(image, scalefactor=1.0, size=(image.shape[1],image.shape[0]), #w,h
-                               mean=(104.00698793, 116.66876762, 122.67891434),
-                               swapRB=False, crop=False)
-    net.setInput(inp)
-    out = net.forward()
-    cv.dnn_unregisterLayer('Crop') # get rid of issues when run in a loop
-    out = out[0,0]
-    return out
-
-
-def edges_hed(img, gauss=None, plot=[]):
-
-    if gauss:
-        img = filters.gaussian(img, sigma=16, truncate=gauss/16, multichannel=True)
-    
-    img = img/np.amax(img)*255
-    img = img.astype(np.uint8)    
-    
-    hed_matrix = hed_edges(img)
-    
-    # gray to binary
-    hed_seg = np.ones((hed_matrix.shape[0],hed_matrix.shape[1]))
-    hed_seg[hed_matrix<0.5]=0
-    
-    # skeletonize to get inner lines
-    img_edges = sk.morphology.skeletonize(hed_seg).astype(int)
+    def __init__(self, params, blobs):
+        self.xstart = 0
+        self.xend = 0
+        self.ystart = 0
+        self.yend = 0
+    # Our layer receives two inputs. We need to crop the first input blob
+    # to match a shape of the second one (keeping batch size and number of channels)
+    def getMemoryShapes(self, inputs):
+        inputShape, targetShape = inputs[0], inputs[1]
+        batchSize, numChannels = inputShape[0], inputShape[1]
+        height, width = targetShape[2], targetShape[3]
+        self.ystart = int((inputShape[2] - targetShape[2]) / 2)
+        self.xstart = int((inputShape[3] - targetShape[3]) / 2)
+        self.yend = self.ystart + height
+        self.xend = self.xstart + width
+        return [[batchSize, numChannels, height, width]]
+    def forward(self, inputs):
+        return [inputs[0][:,:,self.ystart:self.yend,self.xstart:self.xend]]
+
+
+class HedSession(object):
+    # HED network which is loaded only once and then used for any number of images
+    # threads: number of threads used by openCV while this session runs (None => openCV default)
+    # Remark: one session per worker process, calls from several threads are serialized
+    def __init__(self, threads=None, hed_path=None):
+        import cv2 as cv
+        self.cv = cv
+        self.threads = threads
+        # Load the pretrained model (source: https://github.com/s9xie/hed)
+        if hed_path is None:
+            script_path = Path(__file__).parent.absolute()
+            hed_path = Path.joinpath(script_path, 'HED')
+        hed_path = Path(hed_path)
+        self.net = cv.dnn.readNetFromCaffe(str(hed_path / 'deploy.prototxt'),
+                                           str(hed_path / 'hed_pretrained_bsds.caffemodel') )
+
+    def run(self, image):
+        return self.run_batch([image])[0]
+
+    def run_batch(self, images):
+        # images of the same size are passed through the network together
+        cv = self.cv
+        outs = [None]*len(images)
+        shapes = {}
+        for i,image in enumerate(images):
+            shapes.setdefault(image.shape[:2], []).append(i)
+        with _cv_lock: # thread count and crop layer are global settings of openCV
+            # the crop layer is registered only while the session is used
+            # (get rid of issues with other networks or when run in a loop)
+            cv.dnn_registerLayer('Crop', CropLayer)
+            threads = cv.getNumThreads()
+            if self.threads is not None:
+                cv.setNumThreads(self.threads)
+            try:
+                for (h,w),indices in shapes.items():
+                    # prepare images as input dataset (mean values from full image dataset)
+                    inp = cv.dnn.blobFromImages([images[i] for i in indices], scalefactor=1.0, size=(w,h),
+                                                mean=(104.00698793, 116.66876762, 122.67891434),
+                                                swapRB=False, crop=False)
+                    self.net.setInput(inp)
+                    out = self.net.forward()
+                    for j,i in enumerate(indices):
+                        outs[i] = out[j,0]
+            finally:
+                cv.setNumThreads(threads)
+                cv.dnn_unregisterLayer('Crop')
+        return outs
+
+
+_cv_lock = threading.Lock()
+_sessions = {}
+
+def get_session(threads=None):
+    # HED session which is shared by all calls within this process
+    if threads not in _sessions:
+        _sessions[threads] = HedSession(threads=threads)
+    return _sessions[threads]
+
+
+def hed_edges(image, session=None):
+    if session is None:
+        session = get_session()
+    return session.run(image)
+
+
+def tile_starts(n, tile, overlap):
+    # start of overlapping windows of size tile which cover 0...n
+    last = max(n-tile, 0)
+    step = max(tile-overlap, 1)
+    return sorted(set(min(s, last) for s in range(0, last+step, step)))
+
+
+def blend_weights(start, size, n, overlap):
+    # linear ramps where the window overlaps with its neighbours (not at the image border)
+    weights = np.ones(size, dtype=np.float32)
+    ramp = np.arange(1, overlap+1, dtype=np.float32)/(overlap+1)
+    if start > 0:
+        weights[:overlap] = np.minimum(weights[:overlap], ramp[:size])
+    if start+size < n:
+        weights[-overlap:] = np.minimum(weights[-overlap:], ramp[::-1][-size:])
+    return weights
+
+
+def hed_edges_tiled(img, session=None, gauss=None, tile=1024, overlap=64, batch=4):
+    # HED for images of any size: overlapping windows (batch of them at once through the network),
+    # blurred and normalized window by window, seams are blended with linear weights
+    if session is None:
+        session = get_session()
+    h,w = img.shape[0],img.shape[1]
+    scale = 255/np.amax(img)
+    pad = int(gauss)+1 if gauss else 0 # context for the blur (radius of the gaussian filter is gauss)
+    edges_sum = np.zeros((h,w), dtype=np.float32)
+    weights_sum = np.zeros((h,w), dtype=np.float32)
+    windows = [(y0,x0) for y0 in tile_starts(h, tile, overlap) for x0 in tile_starts(w, tile, overlap)]
+    for i0 in range(0, len(windows), batch):
+        images = []
+        for y0,x0 in windows[i0:i0+batch]:
+            ya, xa = max(y0-pad, 0), max(x0-pad, 0)
+            window = img[ya:y0+tile+pad, xa:x0+tile+pad]
+            if gauss:
+                window = filters.gaussian(window, sigma=16, truncate=gauss/16, preserve_range=True, **RGB)
+            window = window[y0-ya:y0-ya+tile, x0-xa:x0-xa+tile]
+            images += [np.clip(window*scale, 0, 255).astype(np.uint8)]
+        for (y0,x0),image,out in zip(windows[i0:i0+batch], images, session.run_batch(images)):
+            th,tw = image.shape[0],image.shape[1]
+            weights = np.outer(blend_weights(y0, th, h, overlap), blend_weights(x0, tw, w, overlap))
+            edges_sum[y0:y0+th, x0:x0+tw] += weights*out
+            weights_sum[y0:y0+th, x0:x0+tw] += weights
+        metrics.add('hed_windows', len(images))
+    edges_sum /= weights_sum
+    return edges_sum
+
+
+def edges_hed(img, gauss=None, plot=[], session=None, tile=None, overlap=64):
+    # tile: images larger than tile*tile are processed in overlapping windows (see hed_edges_tiled)
+
+    if tile and (img.shape[0] > tile or img.shape[1] > tile):
+        hed_matrix = hed_edges_tiled(img, session, gauss, tile, overlap)
+    else:
+        if gauss:
+            img = filters.gaussian(img, sigma=16, truncate=gauss/16, **RGB)
+        
+        img = img/np.amax(img)*255
+        img = img.astype(np.uint8)    
+        
+        hed_matrix = hed_edges(img, session)
+    
+    # gray to binary and skeletonize to get inner lines
+    img_edges = sk.morphology.skeletonize(hed_matrix>=0.5).astype(np.uint8 if tile else int)
 
     # option to make plot lines thicker:
     #from skimage.morphology import square,dilation
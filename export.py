@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Export of mosaics as vector graphics (without matplotlib)
+=======================================================================
+Tiles are written chunk by chunk directly into a file (or any object with a
+write() method), i.e. the document is never kept in memory as a whole.
+File names ending with .svgz are gzip-compressed.
+Coordinates of a whole chunk are formatted with a single string operation.
+"""
+
+import gzip
+import numpy as np
+import shapely
+
+SVG_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<svg xmlns="http://www.w3.org/2000/svg" version="1.1" baseProfile="full" width="{w}" height="{h}" viewBox="0 0 {w} {h}">
+<rect width="100%" height="100%" fill="{background}"/>
+"""
+
+
+def rgb_array(colors, n):
+    # colors (0...1) as integer rgb values; strings => grayscale (as in coloring.modify_colors)
+    # colors=None => silver (as in plotting.draw_tiles)
+    if colors is None or len(colors) == 0:
+        return np.tile([192,192,192], (n,1))
+    if isinstance(colors[0], str):
+        colors = [[float(c)]*3 for c in colors]
+    return np.clip(np.round(np.asarray(colors, dtype=float)[:,:3]*255), 0, 255).astype(int)
+
+
+def _polygon_template(n, precision):
+    # n corners => format string for one tile
+    xy = f'%.{precision}f %.{precision}f'
+    return '<polygon points="' + ' '.join([xy]*n) + '" fill="rgb(%d,%d,%d)"/>\n'
+
+
+def tile_corners(polygons):
+    # all corners (without the closing point) and number of corners of each tile
+    if hasattr(polygons, 'offsets'): # tileset.TileSet => already stored this way
+        return polygons.coords, polygons.counts
+    if hasattr(shapely, 'get_coordinates'): # shapely >= 2.0 => all tiles at once
+        coords, index = shapely.get_coordinates(shapely.get_exterior_ring(np.array(polygons, dtype=object)),
+                                                return_index=True)
+        counts = np.bincount(index, minlength=len(polygons))
+        last = np.cumsum(counts)-1
+        keep = np.ones(len(coords), dtype=bool)
+        keep[last[counts>0]] = False
+        return coords[keep], np.maximum(counts-1, 0)
+    corners = [np.asarray(p.exterior.coords)[:-1] for p in polygons]
+    return np.concatenate(corners+[np.zeros((0,2))]), np.array([len(c) for c in corners], dtype=int)
+
+
+def svg_chunks(polygons, colors, precision=1, chunk_size=5000):
+    # yields the svg elements of chunk_size tiles as one string
+    rgb = rgb_array(colors, len(polygons))
+    templates = {}
+    for i0 in range(0, len(polygons), chunk_size):
+        corners, counts = tile_corners(polygons[i0:i0+chunk_size]) # (TileSet => view of its arrays)
+        for n in set(counts.tolist()) - set(templates):
+            templates[n] = _polygon_template(n, precision)
+        # values of each tile: x,y of all corners followed by r,g,b
+        sizes = 2*counts+3
+        starts = np.cumsum(sizes)-sizes
+        values = np.zeros(sizes.sum())
+        is_color = np.zeros(len(values), dtype=bool)
+        is_color[(starts+2*counts)[:,None]+np.arange(3)] = True
+        values[is_color] = rgb[i0:i0+chunk_size].ravel()
+        values[~is_color] = corners.ravel()
+        yield ''.join([templates[n] for n in counts.tolist()]) % tuple(values.tolist())
+
+
+def write_svg(polygons, colors, h, w, fname, background='dimgrey', precision=1, chunk_size=5000):
+    # fname: file name (*.svg or *.svgz) or open text file
+    # precision: decimal places of the coordinates
+    if not (h and w): # size from the tiles
+        corners, _ = tile_corners(polygons)
+        w, h = np.ceil(corners.max(axis=0)).astype(int).tolist() if len(corners) else (0, 0)
+    if hasattr(fname, 'write'):
+        fn, close = fname, False
+    elif str(fname).endswith('.svgz'):
+        fn, close = gzip.open(fname, 'wt', encoding='utf-8'), True
+    else:
+        fn, close = open(fname, 'w', encoding='utf-8'), True
+    try:
+        fn.write(SVG_HEADER.format(h=h, w=w, background=background))
+        for chunk in svg_chunks(polygons, colors, precision, chunk_size):
+            fn.write(chunk)
+        fn.write('</svg>\n')
+    finally:
+        if close:
+            fn.close()
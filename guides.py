@@ -4,56 +4,74 @@
 
 """
 
+from pathlib import Path
 import numpy as np
-from skimage import draw
-from scipy.ndimage import label, morphology
-import copy
-import time
+import cv2
+from scipy.ndimage import label, find_objects, morphology
 import skimage as sk
 import matplotlib as mpl
 import plotting
+import metrics
+import raster
 mpl.rcParams['figure.dpi'] = 300
 
 
 
-def pixellines_to_ordered_points(matrix, half_tile):
-    # break guidelines into chains and order the pixel for all chain
+NEIGHBOURS = [(+1,0),(-1,0),(+1,-1),(-1,+1),(0,-1,),(0,+1),(-1,-1),(+1,+1)]
+
+
+def trace_component(points):
+    # split one connected pixel component (array of its [x,y] pixels in row-major order)
+    # into subchains of ordered points; each pixel is visited a constant number of times
+    remaining = set(map(tuple, points.tolist()))
+    subchains = []
+    for x,y in points.tolist(): # row-major order => same starting points as before
+        if (x,y) not in remaining: continue # already part of a previous subchain
+        done = False
+        subchain = []
+        while not done:
+            subchain += [[x,y]]
+            remaining.discard((x,y))
+            done = True
+            for dx,dy in NEIGHBOURS:
+                if (x+dx,y+dy) in remaining: # check for pixel here
+                    x,y = x+dx, y+dy # if yes, jump here
+                    done = False # tell the middle loop that the chain is not finished
+                    break # break inner loop
+        subchains += [subchain]
+    return subchains
+
+
+def contour_component(points):
+    # alternative using openCV results in closed chains (might be better), but a few chains are missing
+    x0,y0 = points.min(axis=0)
+    pixel = np.zeros(points.max(axis=0)-(x0,y0)+1, dtype=np.uint8) # small mask around this component
+    pixel[points[:,0]-x0, points[:,1]-y0] = 1
+    contours,_ = cv2.findContours(pixel, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    return [(c.reshape((-1,2))[:,::-1]+(x0,y0)).tolist() for c in contours]
 
-    # import cv2
-    # chains3 = []
+
+def pixellines_to_ordered_points(matrix, half_tile, method='trace'):
+    # break guidelines into chains and order the pixel for all chain
+    # method: 'trace' (default) or 'contours' (openCV, closed chains)
+    if method == 'trace':
+        split_component = trace_component
+    elif method == 'contours':
+        split_component = contour_component
+    else:
+        raise ValueError('Parameter for chain extraction method not understood.')
 
     matrix = sk.morphology.skeletonize(matrix) # nicer lines, better results
     matrix_labeled, chain_count = label(matrix, structure=[[1,1,1], [1,1,1], [1,1,1]]) # find chains
+    # pixels of all chains at once, grouped by chain (stable sort => row-major order within each chain)
+    points = np.argwhere(matrix_labeled)
+    labels = matrix_labeled[points[:,0], points[:,1]]
+    order = np.argsort(labels, kind='stable')
+    points, labels = points[order], labels[order]
+    bounds = np.searchsorted(labels, np.arange(1, chain_count+1))
     chains = []
     for i_chain in range(1,chain_count):
-        pixel = copy.deepcopy(matrix_labeled)
-        pixel[pixel!=i_chain] = 0
-        
-        # alternative using openCV results results in closed chains (might be better), but a few chains are missing
-        # hierarchy,contours = cv2.findContours(pixel.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-        # for h in hierarchy:
-        #     h2 = h.reshape((-1,2))
-        #     h3 = [list(xy)[::-1] for xy in h2]
-        # if len(h3)>3:
-        #     chains3 += [ h3 ]
-        
-        
-        while True:
-            points = np.argwhere(pixel!=0)
-            if len(points)==0: break
-            x,y = points[0] # set starting point
-            done = False
-            subchain = []
-            while not done:
-                subchain += [[x,y]]
-                pixel[x,y] = 0
-                done = True
-                for dx,dy in [(+1,0),(-1,0),(+1,-1),(-1,+1),(0,-1,),(0,+1),(-1,-1),(+1,+1)]:
-                    if x+dx>=0 and x+dx<pixel.shape[0] and y+dy>=0 and y+dy<pixel.shape[1]: # prüfen ob im Bild drin
-                        if pixel[x+dx,y+dy]>0: # check for pixel here
-                            x,y = x+dx, y+dy # if yes, jump here
-                            done = False # tell the middle loop that the chain is not finished
-                            break # break inner loop
+        for subchain in split_component(points[bounds[i_chain-1]:bounds[i_chain]]):
             if len(subchain)>half_tile//2:
                 chains += [subchain]
    
@@ -61,10 +79,64 @@ def pixellines_to_ordered_points(matrix, half_tile):
 
 
 
-def chains_and_angles(img_edges, half_tile, plot=[]):
+def angle_field(distances, points=None):
+    # direction of steepest ascent of the distance field (central differences)
+    # => rotation of tiles when placed later
+    # points: optional list of [x,y] pixels (e.g. all points of the chains),
+    #         if given the angles are only evaluated there (sparse mode)
+    w,h = distances.shape[0],distances.shape[1]
+    gradient = np.zeros((w,h))
+    if points is None:
+        numerator = distances[1:-1,2:]-distances[1:-1,:-2]
+        denominator = distances[2:,1:-1]-distances[:-2,1:-1]
+        gradient[1:-1,1:-1] = np.arctan2(numerator, denominator)
+    elif len(points):
+        xx,yy = np.asarray(points).reshape((-1,2)).T
+        inside = (xx>0) & (xx<w-1) & (yy>0) & (yy<h-1) # border stays zero as in dense mode
+        xx,yy = xx[inside],yy[inside]
+        numerator = distances[xx,yy+1]-distances[xx,yy-1]
+        denominator = distances[xx+1,yy]-distances[xx-1,yy]
+        gradient[xx,yy] = np.arctan2(numerator, denominator)
+    return gradient
+
+
+
+def field(workdir, name, shape, dtype):
+    # full-frame array: memory-mapped *.npy file inside of workdir (large images) or in memory
+    if workdir:
+        return np.lib.format.open_memmap(str(Path(workdir) / f'{name}.npy'), mode='w+', dtype=dtype, shape=shape)
+    return np.zeros(shape, dtype=dtype)
+
+
+def angle_blocks(distances, angles_0to180, block_rows=2048):
+    # dense angle field in blocks of rows (one extra row above and below => same result as angle_field)
+    w = distances.shape[0]
+    for r0 in range(0, w, block_rows):
+        r1 = min(r0+block_rows, w)
+        a0, a1 = max(r0-1, 0), min(r1+1, w)
+        gradient = angle_field(distances[a0:a1])[r0-a0:r1-a0]
+        angles_0to180[r0:r1] = (gradient*180/np.pi+180) % 180
+    return angles_0to180
+
+
+def chains_and_angles(img_edges, half_tile, plot=[], sparse=False, chain_method='trace', workdir=None, low_memory=False):
+    # workdir: directory for memory-mapped distance and angle fields (large images, angles as float32),
+    #          None => arrays in memory
+    # low_memory: distance and angle fields as float32 (distances by openCV => no float64 or index arrays)
 
     # for each pixel get distance to closest edge
-    distances = morphology.distance_transform_edt(img_edges==0,)
+    if low_memory:
+        # (exact euclidean distances as well, integer parts same as distance_transform_edt)
+        distances = cv2.distanceTransform((img_edges==0).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+        if workdir: # into the memory-mapped field
+            in_memory, distances = distances, field(workdir, 'distances', img_edges.shape[:2], np.float32)
+            distances[:] = in_memory
+            del in_memory
+    elif workdir:
+        distances = field(workdir, 'distances', img_edges.shape[:2], np.float64)
+        morphology.distance_transform_edt(img_edges==0, distances=distances)
+    else:
+        distances = morphology.distance_transform_edt(img_edges==0,)
 
     # tiles will be placed centered along guidelines (closed lines)
     """     tile
@@ -76,45 +148,80 @@ def chains_and_angles(img_edges, half_tile, plot=[]):
     """
     w,h = img_edges.shape[0],img_edges.shape[1]
     guidelines = np.zeros((w, h), dtype=np.uint8)
-    mask = ( (distances.astype(int)+half_tile) % (2*half_tile)==0)
-    guidelines[mask] = 1
+    for r0 in range(0, w, 2048): # in blocks of rows => no full-frame integer copy of the distances
+        guidelines[r0:r0+2048] = ( (distances[r0:r0+2048].astype(int)+half_tile) % (2*half_tile)==0)
     # break into chains and order the points
-    t0 = time.time()
-    chains = pixellines_to_ordered_points(guidelines, half_tile)
-    print ('Pixel guidelines to chains with sorted points:', f'{time.time()-t0:.1f}s')
+    with metrics.stage('pixellines_to_ordered_points') as record:
+        chains = pixellines_to_ordered_points(guidelines, half_tile, method=chain_method)
+        record['chains'] = len(chains)
 
     # use distances to calculate gradients => rotation of tiles when placed later
-    t0 = time.time()
-    gradient = np.zeros((w,h))
-    for x in range(1,w-1):
-        for y in range(1,h-1):
-            numerator = distances[x,y+1]-distances[x,y-1]
-            denominator = distances[x+1,y]-distances[x-1,y]
-            gradient[x,y] = np.arctan2(numerator, denominator)
-    angles_0to180 = (gradient*180/np.pi+180) % 180
-    print ('Calculation of angle matrix:', f'{time.time()-t0:.1f}s')  
-    # Remark: it would be enough to calculate only x,y inside the chain => faster
+    # sparse=True: only x,y inside the chains are calculated (other angles stay 0)
+    with metrics.stage('angle_field'):
+        if workdir or low_memory: # dense, block by block into the (memory-mapped) float32 field
+            gradient = None
+            angles_0to180 = angle_blocks(distances, field(workdir, 'angles_0to180', (w,h), np.float32))
+            if workdir:
+                angles_0to180.flush()
+        else:
+            points = [xy for chain in chains for xy in chain] if sparse else None
+            gradient = angle_field(distances, points)
+            angles_0to180 = (gradient*180/np.pi+180) % 180
     # interim_stages = dict(distances=distances, guidelines=guidelines, chains=chains,
     #                       gradient=gradient, angles_0to180=angles_0to180)
     
     if 'distances' in plot: plotting.plot_image(distances, title='distances')
     if 'guidelines' in plot: plotting.plot_image(guidelines, inverted=True, title='guidelines')
-    if 'gradient' in plot: plotting.plot_image(gradient, title='gradients')
+    if 'gradient' in plot and gradient is not None: plotting.plot_image(gradient, title='gradients')
     if 'angles_0to180' in plot: plotting.plot_image(angles_0to180)
     
     return chains, angles_0to180#, interim_stages
 
 
 
-def chains_into_gaps(polygons, h, w, half_tile, CHAIN_SPACING, plot=[]):
-    # get area which are already occupied
-    img_chains = np.zeros((h, w), dtype=np.uint8)
-    for p in polygons:
-        y,x = p.exterior.coords.xy
-        rr, cc = draw.polygon(x, y, shape=img_chains.shape)
-        img_chains[rr, cc] = 1
-    distance_to_tile = morphology.distance_transform_edt(img_chains==0)
-    d = distance_to_tile.astype(int)
+def chains_into_gaps(polygons, h, w, half_tile, CHAIN_SPACING, plot=[], chain_method='trace', return_occupancy=False,
+                     region=None, low_memory=False):
+    # return_occupancy: also return the occupancy mask of the polygons (1 => covered, see raster.occupancy)
+    # region: bool mask, only gaps inside of it are considered (None => whole image)
+    # low_memory: distances as float32 and int16
+    with metrics.stage('chains_into_gaps', n_in=len(polygons)) as record:
+        chains2, img_chains, distance_to_tile, guidelines2 = find_gaps(polygons, h, w, half_tile, CHAIN_SPACING, chain_method,
+                                                                       region, low_memory)
+        record['chains'] = len(chains2)
+    
+    if 'used_up_space' in plot: plotting.plot_image(img_chains, title='gaps')
+    if 'distance_to_tile' in plot: plotting.plot_image(distance_to_tile, inverted=True)
+    if 'filler_guidelines' in plot: plotting.plot_image(guidelines2, inverted=True, title='new guidelines')
+        
+    if return_occupancy:
+        return chains2, img_chains
+    return chains2
+
+
+def gap_distances(img_chains, dtype=np.float64):
+    # distance of each free pixel to the closest occupied one (0 for occupied pixels)
+    # only calculated inside of the bounding boxes of the gaps: the closest occupied pixel
+    # of a gap is on its border => box with a margin of one pixel is sufficient
+    distance_to_tile = np.zeros(img_chains.shape, dtype=dtype)
+    gaps, n = label(img_chains==0)
+    for i, box in enumerate(find_objects(gaps)):
+        box = tuple(slice(max(s.start-1, 0), s.stop+1) for s in box)
+        inside = gaps[box]==i+1
+        distance_to_tile[box][inside] = morphology.distance_transform_edt(img_chains[box]==0)[inside]
+    metrics.note('gaps', n)
+    return distance_to_tile
+
+
+def find_gaps(polygons, h, w, half_tile, CHAIN_SPACING, chain_method='trace', region=None, low_memory=False):
+    # get area which are already occupied (all polygons at once)
+    img_chains = raster.occupancy(polygons, h, w)
+    dtype = np.float32 if low_memory else np.float64
+    if region is not None: # outside of the region everything counts as occupied
+        distance_to_tile = gap_distances(img_chains | ~region, dtype)
+    else:
+        distance_to_tile = gap_distances(img_chains, dtype)
+    # (int16: distances below 32768 pixels)
+    d = distance_to_tile.astype(np.int16 if low_memory and max(h, w) < 2**15 else int)
     
     # define new guidelines
     chain_spacing = int(round(half_tile*CHAIN_SPACING)) 
@@ -127,13 +234,8 @@ def chains_into_gaps(polygons, h, w, half_tile, CHAIN_SPACING, plot=[]):
     
     guidelines2 = np.zeros((h, w), dtype=np.uint8)
     guidelines2[mask] = 1
-    chains2 = pixellines_to_ordered_points(guidelines2, half_tile)
-    
-    if 'used_up_space' in plot: plotting.plot_image(img_chains, title='gaps')
-    if 'distance_to_tile' in plot: plotting.plot_image(distance_to_tile, inverted=True)
-    if 'filler_guidelines' in plot: plotting.plot_image(guidelines2, inverted=True, title='new guidelines')
-        
-    return chains2
+    chains2 = pixellines_to_ordered_points(guidelines2, half_tile, method=chain_method)
+    return chains2, img_chains, distance_to_tile, guidelines2
 
 
 
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Timing and counters for the stages of the mosaic pipeline
+=======================================================================
+Example:
+    recorder = Recorder(verbose=True)
+    with use(recorder):
+        with stage('place_tiles_along_chains', n_in=len(chains)) as record:
+            ...
+            record['n_out'] = len(polygons)
+    print(recorder.to_json())
+
+Each stage records wall time, CPU time, tile counts in/out and an estimate of
+the number of GEOS operations (geos_ops_est, see count_geos).
+Recorder(memory=True) adds the resident memory of the process in MB: rss_mb at
+the end of the stage, peak_rss_mb, the highest value during the stage, and
+peak_increase_mb, the peak minus the memory at the start of the stage. On linux
+the peak is measured by resetting the high-water mark of the process at the start
+of each stage, elsewhere only at the start and end of stages (and when the
+lifetime peak of the process grows). Memory of worker processes is not included.
+Without an active recorder stages are still timed, but nothing is printed.
+"""
+
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError: # windows
+    resource = None
+
+
+_geos_ops = 0
+
+def count_geos(n=1):
+    # called by the stages with the (estimated) number of shapely (GEOS) operations they run
+    # => not a count of the actual calls into GEOS, but comparable between runs
+    global _geos_ops
+    _geos_ops += n
+
+
+def rss_mb():
+    # current resident memory of this process (None if unknown)
+    try:
+        with open('/proc/self/statm') as fn:
+            return int(fn.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+    except (OSError, ValueError, AttributeError): # no /proc (e.g. macOS)
+        return None
+
+
+def lifetime_peak_mb():
+    # highest resident memory of this process so far (None if unknown)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/2**20 if sys.platform == 'darwin' else peak/2**10 # bytes on macOS, kB on linux
+
+
+def reset_peak():
+    # start a new measurement of the peak (resets VmHWM on linux), False if not possible
+    try:
+        with open('/proc/self/clear_refs', 'w') as fn:
+            fn.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_since_reset_mb():
+    # highest resident memory since the last reset_peak() (None if unknown)
+    try:
+        with open('/proc/self/status') as fn:
+            for line in fn:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/2**10 # kB
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class Recorder(object):
+    # verbose: print each finished stage
+    # callback: function which gets the record (dict) of each finished stage
+    # keep: collect all records for report()
+    # memory: record resident memory of each stage (rss_mb, peak_rss_mb, peak_increase_mb)
+
+    def __init__(self, verbose=False, callback=None, keep=True, memory=False):
+        self.verbose = verbose
+        self.callback = callback
+        self.keep = keep
+        self.memory = memory
+        self.records = []
+        self._open = [] # records of running stages (nested stages)
+        self._peaks = [] # highest memory so far of each running stage
+        self._reset = False # high-water mark was reset at the start of the latest stage
+        self._lifetime = lifetime_peak_mb() if memory else None
+
+    def _update_peaks(self):
+        # the highest memory since the last check belongs to all running stages
+        peak = peak_since_reset_mb() if self._reset else None
+        if peak is None: # memory now, or the lifetime peak if it grew meanwhile
+            peak = rss_mb()
+            lifetime = lifetime_peak_mb()
+            if lifetime is not None and self._lifetime is not None and lifetime > self._lifetime:
+                peak = lifetime
+            self._lifetime = lifetime
+        if peak is not None:
+            self._peaks = [max(p, peak) for p in self._peaks]
+
+    @contextmanager
+    def stage(self, name, n_in=None):
+        record = dict(name=name, depth=len(self._open), n_in=n_in, n_out=None)
+        if self.memory:
+            self._update_peaks() # (before the reset => outer stages keep their peak)
+            start = rss_mb() or 0
+            self._peaks += [start]
+            self._reset = reset_peak()
+        self._open += [record]
+        wall, cpu, geos = time.perf_counter(), time.process_time(), _geos_ops
+        try:
+            yield record
+        finally:
+            self._open.pop()
+            record.update(wall=time.perf_counter()-wall, cpu=time.process_time()-cpu,
+                          geos_ops_est=_geos_ops-geos)
+            if self.memory:
+                self._update_peaks()
+                peak = self._peaks.pop()
+                record.update(rss_mb=rss_mb(), peak_rss_mb=peak, peak_increase_mb=peak-start)
+            if self.keep:
+                self.records += [record]
+            if self.verbose:
+                print (format_record(record))
+            if self.callback:
+                self.callback(record)
+
+    def add(self, key, n=1):
+        # add to a counter of the innermost running stage
+        if self._open:
+            self._open[-1][key] = self._open[-1].get(key, 0) + n
+
+    def note(self, key, value):
+        # set a value of the innermost running stage
+        if self._open:
+            self._open[-1][key] = value
+
+    def report(self, start=0):
+        # start: number of the first record (e.g. only the stages of the latest image)
+        records = self.records[start:]
+        top = [r for r in records if r['depth']==0]
+        report = dict(stages=records,
+                      wall=sum(r['wall'] for r in top), cpu=sum(r['cpu'] for r in top))
+        if self.memory:
+            report['peak_rss_mb'] = max([r['peak_rss_mb'] or 0 for r in records], default=None)
+        return report
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.report(), **kwargs)
+
+
+def format_record(record):
+    text = '  '*record['depth'] + f"{record['name']}: {record['wall']:.1f}s (cpu {record['cpu']:.1f}s)"
+    if record['n_in'] is not None or record['n_out'] is not None:
+        text += f", tiles {record['n_in']} -> {record['n_out']}"
+    if record['geos_ops_est']:
+        text += f", ~{record['geos_ops_est']} GEOS operations (estimated)"
+    if record.get('peak_rss_mb'):
+        text += (f", memory {record['rss_mb'] or 0:.0f} MB (peak {record['peak_rss_mb']:.0f} MB, "
+                 f"+{record['peak_increase_mb']:.0f} MB)")
+    extra = {k:v for k,v in record.items() if k not in
+             ['name', 'depth', 'n_in', 'n_out', 'wall', 'cpu', 'geos_ops_est', 'rss_mb', 'peak_rss_mb', 'peak_increase_mb']}
+    if extra:
+        text += ', ' + ', '.join(f'{k}={v}' for k,v in extra.items())
+    return text
+
+
+_active = [Recorder(keep=False)] # default: stages are neither printed nor collected
+
+def current():
+    return _active[-1]
+
+@contextmanager
+def use(recorder):
+    # make recorder the target of all stages within this block
+    _active.append(recorder)
+    try:
+        yield recorder
+    finally:
+        _active.remove(recorder)
+
+def stage(name, n_in=None):
+    return current().stage(name, n_in)
+
+def add(key, n=1):
+    current().add(key, n)
+
+def note(key, value):
+    current().note(key, value)
@@ -8,8 +8,11 @@ Based on algorithm described in "Artificial Mosaics (2005)" by Di Blasi
 """
 
 import time
-import random
-import edges, guides, tiles, convex, coloring, plotting
+import argparse
+import json
+import cv2
+import coloring, export, plotting, metrics, render
+from pipeline import MosaicConfig, MosaicPipeline
 
 # Select filename of input image
 fname = r'' # let empty for test image
@@ -24,6 +27,7 @@ RAND_SIZE = 0.3 # portion of tile size which is added or removed randomly during
 MAX_ANGLE = 40 # 30...75 => max construction angle for tiles along roundings
 GAP_CHAIN_SPACING = 0.5 # 0.4 to 1.0 => spacing of gap filler chains
 MAKE_CONVEX = True # default is True => break concave into more realistic polygons
+CACHE_DIR = '' # e.g. 'cache' => results of expensive stages are reused when running again (let empty to switch off)
 COLOR_SCHEMA = ['nilotic',] # leave empty to plot all available or choose from 'wise_men',
                   #  'fish', 'cave_canem', 'nilotic', 'rooster', 'carpe_diem', 'Hyena'
 
@@ -47,93 +51,120 @@ plot_list = [
     ]
 
 
-# Load image
-t_start = time.time()
-random.seed(0)
-img0 = edges.load_image(fname, plot=plot_list)
-h,w = img0.shape[0],img0.shape[1]
-A0 = (2*half_tile)**2 # area of tile when placed along straight guideline
-print (f'Estimated number of tiles: {2*w*h/A0:.0f}') # factor 2 since tiles can be smaller than default size
-
-# Find edges of image objects
-if EDGE_DETECTION == 'HED':
-    img_edges = edges.edges_hed(img0, gauss=GAUSS, plot=plot_list)
-elif EDGE_DETECTION == 'DiBlasi':
-    img_edges = edges.edges_diblasi(img0, gauss=GAUSS, details=4, plot=plot_list)
-else:
-    raise ValueError('Parameter for edge detection mode not understood.')
-
-
-if WITH_FRAME: 
-    img_edges[0,:]=1; img_edges[-1,:]=1; img_edges[:,0]=1; img_edges[:,-1]=1
-
-
-# place tiles along chains
-chains, angles_0to180 = guides.chains_and_angles(img_edges, half_tile=half_tile, plot=plot_list)
-polygons_chains = tiles.place_tiles_along_chains(chains, angles_0to180, half_tile, RAND_SIZE, MAX_ANGLE, A0, plot=plot_list)
-
-# find gaps and put more tiles inside
-filler_chains = guides.chains_into_gaps(polygons_chains, h, w, half_tile, GAP_CHAIN_SPACING, plot=plot_list)
-polygons_all = tiles.place_tiles_into_gaps(polygons_chains, filler_chains, half_tile, A0, plot=plot_list)
-
-# remove parts of tiles which reach outside of image frame
-polygons_all = tiles.cut_tiles_outside_frame(polygons_all, half_tile, img0.shape[0],img0.shape[1], plot=plot_list)
-
-# convert concave polygons to convex (i.e. more realistic) ones
-polygons_convex = convex.make_convex(polygons_all, half_tile, A0) if MAKE_CONVEX else polygons_all
-
-# make polygons smaller, remove or correct strange polygons, simplify and drop very small polygons
-polygons_post = tiles.irregular_shrink(polygons_convex, half_tile)
-polygons_post = tiles.repair_tiles(polygons_post) 
-polygons_post = tiles.reduce_edge_count(polygons_post, half_tile)
-polygons_post = tiles.drop_small_tiles(polygons_post, A0)
-
-if 'final' in plot_list:
-    # copy colors from original image
-    colors = coloring.colors_from_original(polygons_post, img0, method='average')
-    
-    t0 = time.time()
-    svg = plotting.draw_tiles(polygons_post, colors, h,w, background_brightness=0.2, return_svg=False, chains=None)
-    if svg:
-        with open("output.svg", "w") as fn:
-            fn.write(svg)
-    print ('Final plot / saving:', f'{time.time()-t0:.1f}s') 
-
-if 'final_recolored' in plot_list:
-    color_dict = coloring.load_colors()
-    keys = color_dict.keys() if not COLOR_SCHEMA else COLOR_SCHEMA
-    for key in keys:
-        new_colors = coloring.modify_colors(colors, 'source', color_dict[key])
-        title = key if not COLOR_SCHEMA else ''
-        plotting.draw_tiles(polygons_post, new_colors, h, w, background_brightness=0.2,
-                            return_svg=None, chains=None, title=title)
-
-if 'statistics' in plot_list:
-    plotting.statistics(polygons_post)
-
-print (f'Total calculation time: {time.strftime("%M min %S s", time.gmtime((time.time()-t_start)))}' ) # sek->min:sek
-print ('Final number of tiles:', len(polygons_post))
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+def main(argv=None):
+    # parameters above are the defaults, each can be changed on the command line
+    parser = argparse.ArgumentParser(description='Convert an image into a mosaic constructed by polygons.')
+    parser.add_argument('fname', nargs='?', default=fname, help='input image (let empty for test image)')
+    parser.add_argument('--half-tile', type=int, default=half_tile)
+    parser.add_argument('--gauss', type=int, default=GAUSS)
+    parser.add_argument('--edge-detection', choices=['HED', 'DiBlasi'], default=EDGE_DETECTION)
+    parser.add_argument('--no-frame', dest='with_frame', action='store_false', default=WITH_FRAME)
+    parser.add_argument('--rand-size', type=float, default=RAND_SIZE)
+    parser.add_argument('--max-angle', type=float, default=MAX_ANGLE)
+    parser.add_argument('--gap-chain-spacing', type=float, default=GAP_CHAIN_SPACING)
+    parser.add_argument('--no-convex', dest='make_convex', action='store_false', default=MAKE_CONVEX)
+    parser.add_argument('--post-tolerance', type=float, default=20, help='simplification of tiles (tolerance half_tile/POST_TOLERANCE)')
+    parser.add_argument('--drop-threshold', type=float, default=0.03, help='drop tiles smaller than this portion of the default tile')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--partitions', type=int, nargs=2, default=None, metavar=('NY', 'NX'),
+                        help='place tiles along guidelines in NY*NX regions in parallel')
+    parser.add_argument('--partition-processes', type=int, default=None,
+                        help='worker processes for --partitions and make_convex (default: all cores)')
+    parser.add_argument('--large-image', action='store_true',
+                        help='keep native resolution (tiled HED, memory-mapped fields, placement in regions)')
+    parser.add_argument('--workdir', default='', help='directory for memory-mapped fields of --large-image (default: temporary)')
+    parser.add_argument('--low-memory', action='store_true',
+                        help='uint8 image, float32 fields, free results after their last stage (memory of each stage in --verbose/--metrics)')
+    parser.add_argument('--color-schema', nargs='*', default=COLOR_SCHEMA)
+    parser.add_argument('--color-method', choices=['masked', 'average', 'point'], default='masked')
+    parser.add_argument('--color-statistic', choices=['mean', 'median', 'dominant'], default='mean')
+    parser.add_argument('--color-space', choices=['rgb', 'lab'], default='rgb',
+                        help='color space for matching tiles to a color schema (lab => perceptual distance)')
+    parser.add_argument('--plot', nargs='*', default=plot_list, help='stages to plot (see plot_list)')
+    parser.add_argument('--svg', default='', help='save final mosaic as svg file (*.svgz => compressed)')
+    parser.add_argument('--tiles', default='', help='save tiles and colors (*.npz or directory, see tileset.TileSet)')
+    parser.add_argument('--image', default='', help='save final mosaic as raster image (*.png or *.tif), without matplotlib')
+    parser.add_argument('--scale', type=float, default=1.0, help='size of raster images relative to the prepared image')
+    parser.add_argument('--supersample', type=int, default=2, help='anti-aliasing of raster images (1 => off)')
+    parser.add_argument('--preview', default='', metavar='IMAGE',
+                        help='only save a fast preview (*.png) and estimate the full run (downscaled, no convex/post-processing)')
+    parser.add_argument('--preview-scale', type=float, default=0.25, help='size of the image for --preview')
+    parser.add_argument('--batch', default='', metavar='OUTPUT_DIR',
+                        help='fname is a directory or glob pattern => convert all images into OUTPUT_DIR')
+    parser.add_argument('--video', default='', metavar='OUTPUT_DIR',
+                        help='fname is a video file, directory or glob pattern of frames => animated mosaic in OUTPUT_DIR '
+                             '(tiles of unchanged regions are kept from frame to frame)')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes in batch mode (default: all cores)')
+    parser.add_argument('--formats', nargs='*', default=['svg'], choices=['svg', 'svgz', 'png', 'tif', 'npz'], help='output formats in batch and video mode')
+    parser.add_argument('--verbose', action='store_true', help='print time and tile counts of each stage')
+    parser.add_argument('--metrics', default='', help='save time and tile counts of all stages as json file')
+    args = parser.parse_args(argv)
+
+    config = MosaicConfig(half_tile=args.half_tile, gauss=args.gauss, edge_detection=args.edge_detection,
+                          with_frame=args.with_frame, rand_size=args.rand_size, max_angle=args.max_angle,
+                          gap_chain_spacing=args.gap_chain_spacing, make_convex=args.make_convex,
+                          post_tolerance=args.post_tolerance, drop_threshold=args.drop_threshold,
+                          color_method=args.color_method, color_statistic=args.color_statistic,
+                          cache_dir=args.cache_dir, partitions=args.partitions, processes=args.partition_processes,
+                          large_image=args.large_image, workdir=args.workdir, low_memory=args.low_memory,
+                          plot=args.plot)
+
+    if args.batch:
+        import batch
+        return batch.run_batch(args.fname, args.batch, config, processes=args.processes, formats=args.formats,
+                               scale=args.scale)
+    if args.video:
+        import video
+        return video.run_sequence(args.fname, args.video, config, formats=args.formats, scale=args.scale,
+                                  verbose=args.verbose)
+
+    t_start = time.time()
+    recorder = metrics.Recorder(verbose=args.verbose, memory=args.low_memory)
+    if args.preview: # run again without --preview to refine at full resolution
+        preview = MosaicPipeline(config).preview(args.fname, scale=args.preview_scale, recorder=recorder)
+        cv2.imwrite(args.preview, cv2.cvtColor(preview.image, cv2.COLOR_RGB2BGR))
+        print (f'Preview: {time.time()-t_start:.2f} s, {len(preview.result.polygons)} tiles (half_tile {preview.config.half_tile})')
+        print (f'Full run: about {preview.estimated_tiles} tiles in {preview.estimated_seconds:.0f} s')
+        return preview
+    result = MosaicPipeline(config).run(args.fname, recorder=recorder)
+    polygons, colors, h, w = result.polygons, result.colors, result.h, result.w
+    print (f'Estimated number of tiles: {2*w*h/config.A0:.0f}') # factor 2 since tiles can be smaller than default size
+
+    if args.svg:
+        with metrics.use(recorder), metrics.stage('export_svg', n_in=len(polygons)):
+            export.write_svg(polygons, colors, h, w, args.svg)
+
+    if args.tiles:
+        result.tileset().save(args.tiles)
+
+    if args.image:
+        with metrics.use(recorder), metrics.stage('render_image', n_in=len(polygons)):
+            render.write_image(polygons, colors, h, w, args.image, scale=args.scale, supersample=args.supersample)
+
+    if 'final' in args.plot:
+        with metrics.use(recorder), metrics.stage('plotting', n_in=len(polygons)):
+            plotting.draw_tiles(polygons, colors, h,w, background_brightness=0.2, chains=None)
+
+    if 'final_recolored' in args.plot:
+        color_dict = coloring.load_colors()
+        keys = color_dict.keys() if not args.color_schema else args.color_schema
+        indices = coloring.map_to_palettes(colors, {key:color_dict[key] for key in keys}, args.color_space)
+        for key in keys:
+            new_colors = list(color_dict[key][indices[key]]/255)
+            title = key if not args.color_schema else ''
+            plotting.draw_tiles(polygons, new_colors, h, w, background_brightness=0.2,
+                                return_svg=None, chains=None, title=title)
+
+    if 'statistics' in args.plot:
+        plotting.statistics(polygons)
+
+    print (f'Total calculation time: {time.strftime("%M min %S s", time.gmtime((time.time()-t_start)))}' ) # sek->min:sek
+    print ('Final number of tiles:', len(polygons))
+    if args.metrics:
+        with open(args.metrics, 'w') as fn:
+            json.dump(recorder.report(), fn, indent=1)
+    return result
+
+
+if __name__ == '__main__':
+    main()
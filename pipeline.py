@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Mosaic pipeline which can be used from other Python code
+=======================================================================
+Example:
+    pipeline = MosaicPipeline(MosaicConfig(half_tile=8))
+    result = pipeline.run('image.jpg') # filename, image array or '' for test image
+    plotting.draw_tiles(result.polygons, result.colors, result.h, result.w)
+    pipeline.update(drop_threshold=0.1) # only post-processing and colors are calculated again
+    result = pipeline.run('image.jpg')
+
+Preview (downscaled image, no make_convex and post-processing) before the full run:
+    preview = pipeline.preview('image.jpg') # => preview.image, preview.estimated_tiles, preview.estimated_seconds
+    pipeline.update(gauss=5) # tune and look again ...
+    preview = pipeline.preview('image.jpg')
+    result = pipeline.run('image.jpg') # ... then refine at full resolution with the same parameters
+"""
+
+import math
+import random
+import tempfile
+from pathlib import Path
+from dataclasses import dataclass, field, replace
+from typing import List, Optional, Tuple
+import numpy as np
+import edges, guides, tiles, convex, coloring, cache, metrics, render
+from tileset import TileSet
+from dag import StageGraph
+
+
+@dataclass
+class MosaicConfig:
+    half_tile: int = 12 # 4...30 => half size of mosaic tile
+    gauss: int = 3 # 0...8 => blurs image before edge detection
+    edge_detection: str = 'HED' # HED or DiBlasi
+    with_frame: bool = True # guidelines along image borders
+    rand_size: float = 0.3 # portion of tile size which is added or removed randomly during construction
+    max_angle: float = 40 # 30...75 => max construction angle for tiles along roundings
+    gap_chain_spacing: float = 0.5 # 0.4 to 1.0 => spacing of gap filler chains
+    make_convex: bool = True # break concave into more realistic polygons
+    post_process: bool = True # shrink, repair, simplify and drop tiles (switched off for previews)
+    post_tolerance: float = 20 # tiles are simplified with tolerance half_tile/post_tolerance in post-processing
+    drop_threshold: float = 0.03 # tiles smaller than this portion of A0 are dropped in post-processing
+    color_method: str = 'masked' # 'masked' (pixels inside of tile), 'average' (bounding box) or 'point'
+    color_statistic: str = 'mean' # 'mean', 'median' or 'dominant' color of the pixels (for 'masked')
+    width: Optional[int] = 900 # input image is resized to this width (None => keep size)
+    seed: int = 0 # random seed => same image and config give same mosaic
+    cache_dir: str = '' # reuse results of expensive stages (let empty to switch off)
+    hed_threads: Optional[int] = None # number of openCV threads for HED (None => default)
+    partitions: Optional[Tuple[int,int]] = None # e.g. (4,4) => place tiles in 4*4 regions in parallel
+    processes: Optional[int] = None # worker processes for parallel placement and make_convex (None => all cores)
+    large_image: bool = False # native resolution, uint8 image, tiled HED, memory-mapped fields, placement in regions
+    workdir: str = '' # directory for memory-mapped fields of large images (let empty for temporary directory)
+    hed_tile: int = 1024 # size of HED windows for large images
+    hed_overlap: int = 64 # overlap of HED windows (blended linearly)
+    low_memory: bool = False # uint8 image and edges, float32 fields, results freed after their last stage (no memoizing)
+    plot: List[str] = field(default_factory=list) # interim stages to plot (see mosaic.py)
+
+    @property
+    def A0(self):
+        return (2*self.half_tile)**2 # area of tile when placed along straight guideline
+
+
+@dataclass
+class MosaicResult:
+    polygons: list
+    colors: list
+    h: int
+    w: int
+    timings: dict # seconds per stage
+    metrics: dict # report of all stages (see metrics.Recorder)
+
+    def tileset(self):
+        # compact storage (e.g. to save the mosaic, see tileset.TileSet)
+        return TileSet.from_polygons(self.polygons, self.colors, self.h, self.w)
+
+
+@dataclass
+class PreviewResult:
+    image: np.ndarray # rendered preview (rgb, uint8)
+    result: MosaicResult # tiles in coordinates of the downscaled image
+    config: MosaicConfig # parameters of the preview run
+    scale: float # size of the downscaled image relative to the full run
+    estimated_tiles: int # estimated number of tiles of the full run
+    estimated_seconds: float # estimated time of the full run
+
+
+PIXEL_STAGES = ['load_image', 'edges', 'chains_and_angles'] # time ~ number of pixels, other stages ~ number of tiles
+SKIPPED_IN_PREVIEW = 0.5 # make_convex and post-processing take about half the time of tile placement
+PREVIEW_TILES = 1.5 # the coarse pixel grid of previews leaves about 1/3 fewer tiles per area
+CONVEX_TILES = 1.15 # make_convex splits about 15% of the tiles
+
+
+class MosaicPipeline(object):
+    # keeps everything which is expensive to set up (HED network, cache)
+    # => create once and call run() for any number of images
+    # memoize: after update() of parameters run() only executes the stages depending on them
+    # verbose: print each stage, callback: gets the record (dict) of each finished stage
+
+    def __init__(self, config=None, verbose=False, callback=None, memoize=True, **params):
+        self.config = replace(config or MosaicConfig(), **params)
+        self.verbose = verbose
+        self.callback = callback
+        self.memoize = memoize # keep results of all stages in memory for the next run
+        self.cache = cache.StageCache(self.config.cache_dir)
+        self.graph = self._build_graph()
+        self._hed_session = None
+        self._workdir = None
+        self._preview = None # pipeline of the downscaled image (see preview)
+        self._preview_seconds = {} # time of each stage of the preview
+
+    @property
+    def hed_session(self):
+        if self._hed_session is None:
+            self._hed_session = edges.get_session(self.config.hed_threads)
+        return self._hed_session
+
+    @property
+    def workdir(self):
+        # directory of the memory-mapped fields (large images)
+        if self.config.workdir:
+            Path(self.config.workdir).mkdir(parents=True, exist_ok=True)
+            return self.config.workdir
+        if self._workdir is None:
+            self._workdir = tempfile.TemporaryDirectory(prefix='mosaic_') # removed with the pipeline
+        return self._workdir.name
+
+    def load(self, image):
+        # image: filename, image array or '' (=> test image)
+        c = self.config
+        width = None if c.large_image else c.width
+        dtype = np.uint8 if c.large_image or c.low_memory else int
+        if isinstance(image, np.ndarray):
+            return edges.prepare_image(image, width=width, plot=c.plot, dtype=dtype)
+        return edges.load_image(str(image), width=width, plot=c.plot, dtype=dtype)
+
+    def find_edges(self, img0):
+        c = self.config
+        if c.edge_detection == 'HED':
+            img_edges = edges.edges_hed(img0, gauss=c.gauss, plot=c.plot, session=self.hed_session,
+                                        tile=c.hed_tile if c.large_image else None, overlap=c.hed_overlap)
+        elif c.edge_detection == 'DiBlasi':
+            img_edges = edges.edges_diblasi(img0, gauss=c.gauss, details=4, plot=c.plot,
+                                            dtype=np.float32 if c.low_memory else np.float64)
+        else:
+            raise ValueError('Parameter for edge detection mode not understood.')
+        if c.large_image or c.low_memory: # (values 0 and 1)
+            img_edges = img_edges.astype(np.uint8, copy=False)
+        if c.with_frame:
+            img_edges[0,:]=1; img_edges[-1,:]=1; img_edges[:,0]=1; img_edges[:,-1]=1
+        return img_edges
+
+    def partitions(self, h, w):
+        # regions for placement along chains (large images: about 4096*4096 pixels each)
+        c = self.config
+        if c.partitions or not c.large_image:
+            return c.partitions
+        partitions = (math.ceil(h/4096), math.ceil(w/4096))
+        return partitions if partitions != (1,1) else None
+
+    def place_tiles_along_chains(self, chains, angles_0to180):
+        c = self.config
+        partitions = self.partitions(*angles_0to180.shape[:2])
+        if partitions:
+            return tiles.place_tiles_along_chains_parallel(chains, angles_0to180, c.half_tile, c.rand_size, c.max_angle, c.A0,
+                                                           plot=c.plot, partitions=partitions, processes=c.processes,
+                                                           seed=c.seed)
+        return tiles.place_tiles_along_chains(chains, angles_0to180, c.half_tile, c.rand_size, c.max_angle, c.A0, plot=c.plot)
+
+    def fill_gaps(self, polygons_chains, h, w):
+        # find gaps and put more tiles inside, remove parts of tiles which reach outside of image frame
+        c = self.config
+        filler_chains, occupancy = guides.chains_into_gaps(polygons_chains, h, w, c.half_tile, c.gap_chain_spacing, plot=c.plot,
+                                                           return_occupancy=True, low_memory=c.low_memory)
+        metrics.note('coverage', float(occupancy.mean())) # portion of the image covered before filling the gaps
+        polygons_all = tiles.place_tiles_into_gaps(polygons_chains, filler_chains, c.half_tile, c.A0, plot=c.plot)
+        return tiles.cut_tiles_outside_frame(polygons_all, c.half_tile, h, w, plot=c.plot)
+
+    def update(self, **params):
+        # change parameters, the next run() only executes the stages which depend on them
+        old = self.config
+        self.config = replace(old, **params)
+        if self.config.cache_dir != old.cache_dir:
+            self.cache = cache.StageCache(self.config.cache_dir)
+        if self.config.hed_threads != old.hed_threads:
+            self._hed_session = None
+        if self.config.workdir != old.workdir:
+            self._workdir = None
+
+    def _build_graph(self):
+        # stages of the pipeline, their inputs and the parameters they depend on (see dag.StageGraph)
+        def counted(func, n_in=None):
+            # note tile counts in the metrics record of the stage
+            def stage(*args):
+                if n_in is not None:
+                    metrics.note('n_in', len(args[n_in]))
+                out = func(*args)
+                metrics.note('n_out', len(out))
+                return out
+            return stage
+
+        def chains_and_angles(img_edges):
+            c = self.config
+            chains, angles_0to180 = guides.chains_and_angles(img_edges, half_tile=c.half_tile, plot=c.plot,
+                                                             workdir=self.workdir if c.large_image else None,
+                                                             low_memory=c.low_memory)
+            metrics.note('chains', len(chains))
+            return chains, angles_0to180
+
+        c = lambda: self.config
+        graph = StageGraph()
+        graph.add('load_image', self.load, ['image'], ['width', 'large_image', 'low_memory'])
+        graph.add('edges', self.find_edges, ['load_image'], ['edge_detection', 'gauss', 'with_frame', 'hed_tile', 'hed_overlap'],
+                  'array')
+        graph.add('chains_and_angles', chains_and_angles, ['edges'], ['half_tile'], ('chains', 'array'))
+        graph.add('place_tiles_along_chains', counted(lambda ca: self.place_tiles_along_chains(*ca)),
+                  ['chains_and_angles'], ['half_tile', 'rand_size', 'max_angle', 'seed', 'partitions', 'large_image'],
+                  'polygons', uses_random=True)
+        graph.add('place_tiles_into_gaps', counted(lambda p, e: self.fill_gaps(p, e.shape[0], e.shape[1]), 0),
+                  ['place_tiles_along_chains', 'edges'], ['half_tile', 'gap_chain_spacing'], 'polygons',
+                  uses_random=True)
+        # (without make_convex nothing is stored => no second copy of the tiles in the cache)
+        graph.add('make_convex', counted(lambda p: convex.make_convex(p, c().half_tile, c().A0, processes=c().processes)
+                                         if c().make_convex else p, 0),
+                  ['place_tiles_into_gaps'], ['half_tile', 'make_convex'], lambda config: 'polygons' if config.make_convex else None)
+        # make polygons smaller, remove or correct strange polygons, simplify and drop very small polygons
+        graph.add('post_process', counted(lambda p: tiles.post_process(p, c().half_tile, c().A0, c().post_tolerance,
+                                                                      c().drop_threshold) if c().post_process else p, 0),
+                  ['make_convex'], ['half_tile', 'post_process', 'post_tolerance', 'drop_threshold'], uses_random=True)
+        # copy colors from original image
+        graph.add('colors', lambda p, img0: coloring.colors_from_original(p, img0, method=c().color_method,
+                                                                         statistic=c().color_statistic),
+                  ['post_process', 'load_image'], ['color_method', 'color_statistic'])
+        return graph
+
+    def run(self, image, recorder=None):
+        # recorder: metrics.Recorder which collects the stages (default: new one per image,
+        #           with the memory of each stage in low memory mode)
+        if recorder is None:
+            recorder = metrics.Recorder(verbose=self.verbose, callback=self.callback, memory=self.config.low_memory)
+        n_records = len(recorder.records) # recorder may already contain earlier images
+        keep = None
+        if self.config.low_memory: # only the results needed below, nothing memoized
+            self.graph.clear()
+            keep = ['load_image', 'post_process', 'colors']
+        with metrics.use(recorder):
+            random.seed(self.config.seed)
+            values = self.graph.run(self.config, dict(image=(image_signature(image), image)), store=self.cache, keep=keep)
+        if not self.memoize:
+            self.graph.clear()
+        report = recorder.report(start=n_records)
+        timings = {r['name']:r['wall'] for r in report['stages'] if r['depth']==0}
+        h,w = values['load_image'].shape[:2]
+        return MosaicResult(polygons=values['post_process'], colors=values['colors'], h=h, w=w,
+                            timings=timings, metrics=report)
+
+    def full_width(self, image):
+        # width of the image in the full run
+        c = self.config
+        return c.width if c.width and not c.large_image else native_width(image)
+
+    def preview_config(self, image, scale=0.25):
+        # parameters of the preview: same as the full run, but image and tiles scaled down
+        c = self.config
+        return replace(c, width=max(int(self.full_width(image)*scale), 1), half_tile=max(int(round(c.half_tile*scale)), 2),
+                       make_convex=False, post_process=False, large_image=False, partitions=None,
+                       cache_dir='', plot=[])
+
+    def preview(self, image, scale=0.25, render_scale=None, recorder=None):
+        # fast rough look at the mosaic, the full run is estimated from it
+        # render_scale: size of the rendered preview (None => size of the full run)
+        config = self.preview_config(image, scale)
+        if self._preview is None:
+            self._preview = MosaicPipeline(config, callback=self.callback, verbose=self.verbose)
+        else: # repeated previews only execute the stages depending on changed parameters
+            self._preview.update(**{k:getattr(config, k) for k in config.__dataclass_fields__})
+        result = self._preview.run(image, recorder=recorder)
+        f = result.w/self.full_width(image)
+        img = render.render_image(result.polygons, result.colors, result.h, result.w,
+                                  scale=render_scale or 1/f, supersample=1)
+
+        # tile count ~ image area / tile area, time of each stage ~ pixels or tiles
+        # (memoized stages: time of their last execution)
+        self._preview_seconds.update({r['name']:r['wall'] for r in result.metrics['stages']
+                                      if r['depth'] == 0 and not r.get('memoized')})
+        pixels = 1/f**2
+        n_tiles = len(result.polygons)*pixels*(config.half_tile/self.config.half_tile)**2*PREVIEW_TILES
+        if self.config.make_convex:
+            n_tiles *= CONVEX_TILES
+        seconds = {name:t*(pixels if name in PIXEL_STAGES else n_tiles/max(len(result.polygons), 1))
+                   for name,t in self._preview_seconds.items()}
+        placement = seconds.get('place_tiles_along_chains', 0)+seconds.get('place_tiles_into_gaps', 0)
+        if self.config.make_convex or self.config.post_process:
+            seconds['skipped'] = SKIPPED_IN_PREVIEW*placement
+        return PreviewResult(img, result, config, f, int(round(n_tiles)), sum(seconds.values()))
+
+
+def native_width(image):
+    # width of the image without loading it
+    if isinstance(image, np.ndarray):
+        return image.shape[1]
+    if not image: # test image
+        return edges.load_image('', width=None).shape[1]
+    from PIL import Image
+    Image.MAX_IMAGE_PIXELS = None
+    with Image.open(image) as img:
+        return img.size[0]
+
+
+def image_signature(image):
+    # identifies the input image by its content without decoding it (hash of the file)
+    if isinstance(image, np.ndarray):
+        return cache.image_hash(image)
+    if not image: # test image
+        return ''
+    return cache.file_hash(image)
@@ -3,7 +3,9 @@
 import matplotlib.pyplot as plt
 from matplotlib import patches
 import numpy as np
+import io
 from skimage.util import invert
+import export
 
 
 def plot_image(stage, chains=None, axis_off=True, inverted=False, title=''):
@@ -23,7 +25,8 @@ def plot_image(stage, chains=None, axis_off=True, inverted=False, title=''):
 
 
 def draw_tiles(polygons, colors, h, w, background_brightness=0.25, return_svg=None,
-               chains=None, axis_off=True, title=''):
+               chains=None, axis_off=True, title='', fname=None):
+    # fname: save figure to this file instead of showing it (e.g. *.png)
     fig,ax = plt.subplots(dpi=500)
     if axis_off:
         ax.set_axis_off()
@@ -35,12 +38,6 @@ def draw_tiles(polygons, colors, h, w, background_brightness=0.25, return_svg=No
         ax.invert_yaxis()
         ax.autoscale()
 
-    if return_svg:
-        svg = """<?xml version="1.0" encoding="UTF-8"?>
-                <svg xmlns="http://www.w3.org/2000/svg" version="1.1" baseProfile="full">
-                <rect width="100%" height="100%" fill="dimgrey"/>
-                """
-        
     for j,p in enumerate(polygons): #+
 
         if colors:
@@ -55,20 +52,21 @@ def draw_tiles(polygons, colors, h, w, background_brightness=0.25, return_svg=No
         stein = patches.Polygon(corners, edgecolor=edgecolor, lw=0.3, facecolor=color)# facecolor=color)    
         ax.add_patch(stein)
         
-        if return_svg:
-            svg_koords = ' '.join([f'{x:.1f} {y:.1f}' for x,y in list(p.exterior.coords)])
-            color = (color*255).round()
-            color_svg = 'fill="rgb('+','.join([str(int(c)) for c in color])+')"'
-            svg_p = f'<polygon points="{svg_koords}" {color_svg}/>\n'
-            svg += svg_p
-        
     if chains:
         for chain in chains:
             yy,xx = np.array(chain).T
             ax.plot(xx,yy,lw=0.7) #, c='w'
-    plt.show()
+    if fname:
+        fig.savefig(fname, bbox_inches='tight', pad_inches=0)
+        plt.close(fig)
+    else:
+        plt.show()
     
-    return svg+'</svg>' if return_svg else None
+    if return_svg: # for large mosaics better use export.write_svg directly (no matplotlib, streamed into file)
+        svg = io.StringIO()
+        export.write_svg(polygons, colors, h, w, svg)
+        return svg.getvalue()
+    return None
 
 
 def statistics(polygons):
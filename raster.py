@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Rasterization of tiles into pixel images
+=======================================================================
+A pixel belongs to a tile if its center lies inside of the polygon
+(label_image) or inside or on its boundary (occupancy). With shapely >= 2.0
+all tiles are tested at once, otherwise one tile after another is tested
+with shapely.vectorized (same predicates => same pixels).
+Polygon coordinates are (x,y) = (column,row) as everywhere in the project.
+"""
+
+import numpy as np
+import shapely
+
+
+def label_image(polygons, h, w, chunk_size=5000, boundary=False):
+    # each pixel gets the number of its tile (i+1 for polygons[i]), 0 => no tile
+    # boundary: pixel centers on the boundary of a tile belong to it
+    if not hasattr(shapely, 'contains_xy'): # older shapely
+        return _label_image_loop(polygons, h, w, boundary)
+    labels = np.zeros((h, w), dtype=np.int32)
+
+    # all pixel centers inside of the bounding boxes of the tiles (in chunks => limited memory)
+    for i0 in range(0, len(polygons), chunk_size):
+        geoms = np.array(polygons[i0:i0+chunk_size], dtype=object)
+        bounds = shapely.bounds(geoms)
+        x0 = np.clip(np.ceil(bounds[:,0]), 0, w).astype(int)
+        y0 = np.clip(np.ceil(bounds[:,1]), 0, h).astype(int)
+        x1 = np.clip(np.floor(bounds[:,2])+1, 0, w).astype(int)
+        y1 = np.clip(np.floor(bounds[:,3])+1, 0, h).astype(int)
+        nx, ny = np.maximum(x1-x0, 0), np.maximum(y1-y0, 0)
+        n_pixels = nx*ny
+        i_tile = np.repeat(np.arange(len(geoms)), n_pixels)
+        k = np.arange(len(i_tile)) - np.repeat(np.cumsum(n_pixels)-n_pixels, n_pixels) # pixel number inside the box
+        xx = x0[i_tile] + k % np.maximum(nx[i_tile], 1)
+        yy = y0[i_tile] + k // np.maximum(nx[i_tile], 1)
+        shapely.prepare(geoms)
+        inside = (shapely.intersects_xy if boundary else shapely.contains_xy)(geoms[i_tile], xx, yy)
+        labels[yy[inside], xx[inside]] = i_tile[inside]+i0+1
+    return labels
+
+
+def _label_image_loop(polygons, h, w, boundary=False):
+    # label_image one tile after another (shapely < 2.0)
+    from shapely import vectorized
+    labels = np.zeros((h, w), dtype=np.int32)
+    for i,p in enumerate(polygons):
+        x0, y0, x1, y1 = p.bounds
+        xx, yy = np.meshgrid(np.arange(max(int(np.ceil(x0)), 0), min(int(np.floor(x1))+1, w)),
+                             np.arange(max(int(np.ceil(y0)), 0), min(int(np.floor(y1))+1, h)))
+        inside = vectorized.contains(p, xx, yy)
+        if boundary:
+            inside |= vectorized.touches(p, xx, yy)
+        labels[yy[inside], xx[inside]] = i+1
+    return labels
+
+
+def occupancy(polygons, h, w):
+    # 1 => pixel is covered by a tile (including boundaries)
+    return (label_image(polygons, h, w, boundary=True)>0).astype(np.uint8)
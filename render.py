@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless raster rendering of mosaics (without matplotlib)
+=======================================================================
+Tiles are filled directly into a numpy image with openCV at any scale
+(e.g. scale=20 => 20 output pixels per pixel of the prepared image).
+Anti-aliasing by supersampling: each band of rows is rendered `supersample`
+times larger and reduced by averaging, i.e. only the output image and one
+band have to fit into memory. Pixels not covered by a tile get the grout color.
+A pixel belongs to a tile if its center lies inside (approximately, see inset).
+Tiles are only handled as arrays of corners (tileset.TileSet or shapely polygons
+converted once by export.tile_corners).
+"""
+
+import cv2
+import numpy as np
+import export
+
+SHIFT = 4 # fractional bits of the corner coordinates given to cv2.fillPoly
+MITRE_LIMIT = 5 # corners move at most this multiple of the inset (as the mitre limit of shapely's buffer)
+
+
+def signed_areas(corners, counts, nxt, tile):
+    # signed area of each tile (shoelace), nxt: index of the next corner of the same tile
+    x, y = corners[:,0], corners[:,1]
+    return np.bincount(tile, x*y[nxt]-x[nxt]*y, minlength=len(counts))/2
+
+
+def inset(corners, counts, d):
+    # cv2.fillPoly also fills pixels on the boundary => shrink tiles by about half a pixel
+    # (keeps the grout lines as wide as in raster.label_image)
+    # each edge moves inwards by d (mitre joins), tiles thinner than 2*d are kept as they are
+    if len(corners) == 0:
+        return corners
+    tile = np.repeat(np.arange(len(counts)), counts)
+    starts = np.repeat(np.cumsum(counts)-counts, counts)
+    k = np.arange(len(corners)) - starts # corner number inside the tile
+    nxt = starts + (k+1) % counts[tile]
+    prv = starts + (k-1) % counts[tile]
+    area = signed_areas(corners, counts, nxt, tile)
+
+    # inward normal of the edge from each corner to the next one (left of the edge for positive area)
+    edge = corners[nxt]-corners
+    length = np.hypot(edge[:,0], edge[:,1])
+    normal = np.stack([-edge[:,1], edge[:,0]], axis=1)*(np.sign(area)[tile]/np.maximum(length, 1e-12))[:,None]
+    bisector = normal + normal[prv]
+    cos = 1 + (normal*normal[prv]).sum(axis=1) # 1+cos of the angle between the normals
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = d*bisector/cos[:,None]
+    size = np.hypot(shift[:,0], shift[:,1])
+    spike = ~(size <= MITRE_LIMIT*d) # (also nan)
+    shift[spike] = (MITRE_LIMIT*d*bisector[spike]/np.maximum(np.hypot(bisector[spike,0], bisector[spike,1]), 1e-12)[:,None])
+    shrunk = corners+shift
+
+    flipped = np.sign(signed_areas(shrunk, counts, nxt, tile)) != np.sign(area) # too thin
+    shrunk[flipped[tile]] = corners[flipped[tile]]
+    return shrunk
+
+
+def render_image(polygons, colors, h, w, scale=1.0, supersample=2, grout=(0.2,0.2,0.2), band_rows=512):
+    # returns rgb image (uint8) of size round(h*scale) x round(w*scale)
+    # colors: as for plotting.draw_tiles (rgb 0...1, grayscale strings or None)
+    # grout: rgb color (0...1) between the tiles
+    H, W = int(round(h*scale)), int(round(w*scale))
+    k = max(int(supersample), 1)
+    f = scale*k
+    img = np.zeros((H, W, 3), dtype=np.uint8)
+    grout = np.clip(np.round(np.asarray(grout, dtype=float)*255), 0, 255).astype(np.uint8)
+    rgb = export.rgb_array(colors, len(polygons))
+
+    # pixel x covers x-0.5...x+0.5 (in units of the prepared image, as in raster.label_image)
+    corners, counts = export.tile_corners(polygons)
+    pts = np.round(((inset(corners, counts, 0.45/f)+0.5)*f-0.5)*2**SHIFT).astype(np.int32)
+    tiles = np.split(pts, np.cumsum(counts)[:-1]) if len(polygons) else []
+    # rows of each tile (tiles without corners => empty range)
+    starts = np.minimum(np.cumsum(counts)-counts, max(len(pts)-1, 0))
+    y_min = np.minimum.reduceat(pts[:,1], starts) >> SHIFT if len(pts) else np.zeros(len(tiles), np.int32)
+    y_max = (np.maximum.reduceat(pts[:,1], starts) >> SHIFT) + 1 if len(pts) else np.zeros(len(tiles), np.int32)
+    y_max[counts == 0] = 0
+
+    blank = np.empty((min(band_rows, H)*k, W*k, 3), dtype=np.uint8)
+    for c in range(3): # (faster than broadcasting the color)
+        blank[:,:,c] = grout[c]
+    for r0 in range(0, H, band_rows): # supersampled band of output rows r0...r1
+        r1 = min(r0+band_rows, H)
+        band = blank[:(r1-r0)*k].copy()
+        offset = np.array([0, r0*k*2**SHIFT], dtype=np.int32)
+        for i in np.flatnonzero((y_max >= r0*k) & (y_min < r1*k)): # in drawing order
+            if counts[i] >= 3:
+                cv2.fillPoly(band, [tiles[i]-offset], rgb[i].tolist(), lineType=cv2.LINE_8, shift=SHIFT)
+        img[r0:r1] = cv2.resize(band, (W, r1-r0), interpolation=cv2.INTER_AREA) if k > 1 else band
+    return img
+
+
+def write_image(polygons, colors, h, w, fname, scale=1.0, supersample=2, grout=(0.2,0.2,0.2)):
+    # file format from file name (e.g. *.png or *.tif)
+    img = render_image(polygons, colors, h, w, scale, supersample, grout)
+    if not cv2.imwrite(str(fname), cv2.cvtColor(img, cv2.COLOR_RGB2BGR)):
+        raise IOError(f'Could not write {fname}')
+    return img
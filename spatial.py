@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Spatial index for tiles (uniform grid over bounding boxes)
+=======================================================================
+Tiles can be added one by one while they are placed. Queries always return
+the tiles in the order they were inserted => same results as a linear search.
+An optional OccupancyBitmap (coarse cells) is updated with each tile, it decides
+for many candidates without GEOS whether they are free or covered.
+"""
+
+from collections import defaultdict
+import numpy as np
+import metrics
+
+
+class TileIndex(object):
+
+    def __init__(self, cell_size, polygons=[], bitmap=None):
+        self.cell_size = cell_size # e.g. 2*half_tile
+        self.polygons = []
+        self.cells = defaultdict(list) # (i,j) => ids of polygons
+        self.bitmap = bitmap # OccupancyBitmap or None
+        for p in polygons:
+            self.insert(p)
+
+    def __len__(self):
+        return len(self.polygons)
+
+    def __iter__(self):
+        return iter(self.polygons)
+
+    def _cells(self, bounds):
+        x0,y0,x1,y1 = bounds
+        c = self.cell_size
+        for i in range(int(x0//c), int(x1//c)+1):
+            for j in range(int(y0//c), int(y1//c)+1):
+                yield (i,j)
+
+    def insert(self, p):
+        i_new = len(self.polygons)
+        self.polygons += [p]
+        for cell in self._cells(p.bounds):
+            self.cells[cell] += [i_new]
+        if self.bitmap is not None:
+            self.bitmap.insert(p)
+        return i_new
+
+    def candidates(self, geom):
+        # ids of all polygons whose grid cells overlap with the bounding box of geom
+        ids = set()
+        for cell in self._cells(geom.bounds):
+            ids.update(self.cells.get(cell, []))
+        return sorted(ids)
+
+    def query_ids(self, geom, predicate='intersects'):
+        # ids of polygons which fulfill the predicate with geom (in insertion order)
+        candidates = self.candidates(geom)
+        metrics.count_geos(len(candidates))
+        return [i for i in candidates if getattr(geom, predicate)(self.polygons[i])]
+
+    def query(self, geom, predicate='intersects'):
+        return [self.polygons[i] for i in self.query_ids(geom, predicate)]
+
+
+class OccupancyBitmap(object):
+    # coarse grid of cells over bounds (x0,y0,x1,y1), cell (j,i) is the square x0+i*c...x0+(i+1)*c, y0+j*c...
+    # touched: cell overlaps with the bounding box of a tile => no tile intersects cells which are not touched
+    # container: latest tile whose bounding box contains the cell (-1 => none), full: cell lies inside of it
+    # (tested when needed). Both tests are conservative => same tiles as without bitmap.
+    # Cells outside of bounds are touched, but not full.
+
+    def __init__(self, bounds, cell_size):
+        self.x0, self.y0 = int(np.floor(bounds[0])), int(np.floor(bounds[1]))
+        self.cell_size = c = max(float(cell_size), 1.0)
+        shape = (int(np.ceil((bounds[3]-self.y0)/c))+1, int(np.ceil((bounds[2]-self.x0)/c))+1)
+        self.touched = np.zeros(shape, dtype=bool)
+        self.full = np.zeros(shape, dtype=bool)
+        self.container = np.full(shape, -1, dtype=np.int32)
+        self.polygons = []
+
+    def _range(self, bounds):
+        # rows j0:j1 and columns i0:i1 of the cells overlapping with bounds (including their border)
+        x0,y0,x1,y1 = bounds
+        c = self.cell_size
+        return (int(np.floor((y0-self.y0)/c)), int(np.floor((y1-self.y0)/c))+1,
+                int(np.floor((x0-self.x0)/c)), int(np.floor((x1-self.x0)/c))+1)
+
+    def _inside(self, j0, j1, i0, i1):
+        return j0 >= 0 and i0 >= 0 and j1 <= self.touched.shape[0] and i1 <= self.touched.shape[1]
+
+    def insert(self, p):
+        j0,j1,i0,i1 = self._range(p.bounds)
+        self.touched[max(j0, 0):max(j1, 0), max(i0, 0):max(i1, 0)] = True
+        # cells completely inside of the bounding box
+        self.container[max(j0+1, 0):max(j1-1, 0), max(i0+1, 0):max(i1-1, 0)] = len(self.polygons)
+        self.polygons += [p]
+
+    def _cell_inside(self, p, j, i):
+        # True if no edge of p touches cell (j,i) and its center is inside of p
+        c = self.cell_size
+        xa, ya = self.x0 + i*c, self.y0 + j*c
+        rings = [np.asarray(p.exterior.coords)] + [np.asarray(r.coords) for r in p.interiors]
+        a = np.concatenate([r[:-1] for r in rings]) # edges a => b of all rings
+        b = np.concatenate([r[1:] for r in rings])
+        ax, ay, bx, by = a[:,0], a[:,1], b[:,0], b[:,1]
+        # edge touches cell: bounding boxes overlap and the corners of the cell are not all on one side
+        overlap = ((np.minimum(ax, bx) <= xa+c) & (np.maximum(ax, bx) >= xa) &
+                   (np.minimum(ay, by) <= ya+c) & (np.maximum(ay, by) >= ya))
+        side = np.array([(bx-ax)*(y-ay) - (by-ay)*(x-ax) for x,y in [(xa,ya), (xa+c,ya), (xa,ya+c), (xa+c,ya+c)]])
+        one_side = (side > 0).all(axis=0) | (side < 0).all(axis=0)
+        if (overlap & ~one_side).any():
+            return False
+        # center inside (crossings of a ray to the right, even-odd => holes are outside)
+        cx, cy = xa+c/2, ya+c/2
+        crossing = (ay > cy) != (by > cy)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = ax + (cy-ay)*(bx-ax)/(by-ay)
+        return bool(((crossing & (x_cross > cx)).sum() % 2) == 1)
+
+    def is_free(self, bounds):
+        # True => no tile intersects bounds
+        j0,j1,i0,i1 = self._range(bounds)
+        return self._inside(j0, j1, i0, i1) and not self.touched[j0:j1, i0:i1].any()
+
+    def is_covered(self, bounds):
+        # True => bounds lie completely inside of the tiles
+        j0,j1,i0,i1 = self._range(bounds)
+        if not self._inside(j0, j1, i0, i1):
+            return False
+        full, container = self.full[j0:j1, i0:i1], self.container[j0:j1, i0:i1]
+        if ((container < 0) & ~full).any(): # (most candidates)
+            return False
+        for j,i in zip(*np.nonzero(~full)):
+            if not self._cell_inside(self.polygons[container[j,i]], j0+j, i0+i):
+                container[j,i] = -1 # (until a later tile contains the cell)
+                return False
+            full[j,i] = True
+        return True
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the memoized pipeline (run with pytest)
+=======================================================================
+Small test image and DiBlasi edges => no HED model needed.
+"""
+
+import pytest
+from pipeline import MosaicConfig, MosaicPipeline
+
+CONFIG = MosaicConfig(edge_detection='DiBlasi', half_tile=8, width=300, make_convex=False)
+
+
+def same_tiles(a, b):
+    return len(a.polygons) == len(b.polygons) and all(p.equals_exact(q, 0) for p,q in zip(a.polygons, b.polygons))
+
+
+@pytest.mark.parametrize('seed', [1, 2])
+def test_update_seed_equals_new_pipeline(seed):
+    pipeline = MosaicPipeline(CONFIG)
+    first = pipeline.run('')
+    pipeline.update(seed=seed)
+    updated = pipeline.run('')
+    fresh = MosaicPipeline(CONFIG, seed=seed).run('')
+    assert same_tiles(updated, fresh)
+    assert not same_tiles(first, fresh)
+
+
+def test_cached_stages_respect_seed(tmp_path):
+    MosaicPipeline(CONFIG, cache_dir=str(tmp_path)).run('')
+    cached = MosaicPipeline(CONFIG, cache_dir=str(tmp_path), seed=1).run('')
+    assert same_tiles(cached, MosaicPipeline(CONFIG, seed=1).run(''))
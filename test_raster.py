@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the rasterization of tiles (run with pytest)
+=======================================================================
+"""
+
+import numpy as np
+import pytest
+import shapely
+import raster
+from pipeline import MosaicConfig, MosaicPipeline
+
+
+@pytest.fixture(scope='module')
+def mosaic():
+    return MosaicPipeline(MosaicConfig(edge_detection='DiBlasi', half_tile=8, width=300)).run('')
+
+
+@pytest.mark.skipif(not hasattr(shapely, 'contains_xy'), reason='needs shapely >= 2.0')
+@pytest.mark.parametrize('boundary', [False, True])
+@pytest.mark.filterwarnings('ignore::DeprecationWarning') # shapely.vectorized (the path of older shapely)
+def test_label_image_same_for_all_shapely_versions(mosaic, boundary):
+    h, w = mosaic.h, mosaic.w
+    # tiles with corners on pixel centers => many pixels exactly on tile boundaries
+    polygons = mosaic.polygons + [shapely.box(10, 10, 20, 20), shapely.box(20, 10, 30, 20)]
+    labels = raster.label_image(polygons, h, w, boundary=boundary)
+    assert np.array_equal(labels, raster._label_image_loop(polygons, h, w, boundary))
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the spatial index and the occupancy bitmap (run with pytest)
+=======================================================================
+"""
+
+import numpy as np
+from shapely.geometry import Polygon, box
+from shapely.ops import unary_union
+from spatial import OccupancyBitmap
+
+
+def random_tiles(rng, n=8):
+    # star-shaped (often concave) tiles, some with holes
+    polygons = []
+    for k in range(n):
+        m = rng.integers(3, 9)
+        angles, radii = np.sort(rng.uniform(0, 2*np.pi, m)), rng.uniform(5, 25, m)
+        cx, cy = rng.uniform(10, 90, 2)
+        p = Polygon(np.c_[cx+radii*np.cos(angles), cy+radii*np.sin(angles)])
+        if not p.is_valid:
+            continue
+        if k % 3 == 0:
+            p = p.difference(box(cx-2, cy-2, cx+1, cy+2))
+        if p.geom_type == 'Polygon':
+            polygons += [p]
+    return polygons
+
+
+def test_bitmap_is_conservative():
+    rng = np.random.default_rng(0)
+    n_covered = n_free = 0
+    for t in range(50):
+        bitmap = OccupancyBitmap((0, 0, 100, 100), rng.choice([2, 3.5, 5]))
+        polygons = random_tiles(rng)
+        for p in polygons:
+            bitmap.insert(p)
+        union = unary_union(polygons)
+        for x, y, size in rng.uniform([0, 0, 1], [95, 95, 10], (200, 3)):
+            bounds = (x, y, x+size, y+size)
+            if bitmap.is_covered(bounds):
+                n_covered += 1
+                assert union.covers(box(*bounds))
+            if bitmap.is_free(bounds):
+                n_free += 1
+                assert not union.intersects(box(*bounds))
+    assert n_covered and n_free
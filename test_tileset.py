@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the array-backed tile storage (run with pytest)
+=======================================================================
+"""
+
+import io
+import numpy as np
+import pytest
+import export, render
+from pipeline import MosaicConfig, MosaicPipeline
+from tileset import TileSet
+
+
+@pytest.fixture(scope='module')
+def mosaic():
+    return MosaicPipeline(MosaicConfig(edge_detection='DiBlasi', half_tile=8, width=300)).run('')
+
+
+def test_slices_are_views(mosaic):
+    tiles = mosaic.tileset()
+    part = tiles[10:20]
+    assert isinstance(part, TileSet) and len(part) == 10
+    assert np.shares_memory(part.coords, tiles.coords)
+    assert all(p.equals_exact(q, 0) for p,q in zip(part, mosaic.polygons[10:20]))
+    assert all(p.equals_exact(q, 0) for p,q in zip(tiles[3:40:7], mosaic.polygons[3:40:7]))
+    assert tiles._polygons is None
+
+
+def test_export_and_render_without_polygons(mosaic):
+    tiles = mosaic.tileset()
+    svg_polygons, svg_tiles = io.StringIO(), io.StringIO()
+    export.write_svg(mosaic.polygons, mosaic.colors, mosaic.h, mosaic.w, svg_polygons, chunk_size=100)
+    export.write_svg(tiles, tiles.colors, tiles.h, tiles.w, svg_tiles, chunk_size=100)
+    img = render.render_image(tiles, tiles.colors, tiles.h, tiles.w, scale=2)
+    assert tiles._polygons is None
+    assert svg_polygons.getvalue() == svg_tiles.getvalue()
+    assert np.array_equal(img, render.render_image(mosaic.polygons, mosaic.colors, mosaic.h, mosaic.w, scale=2))
@@ -1,98 +1,118 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import numpy as np
-import time
 import random
 from shapely.geometry import LineString, Polygon, MultiPoint
 from shapely import affinity
+import shapely
+from multiprocessing import Pool, shared_memory
 import plotting
+import metrics
+from spatial import TileIndex, OccupancyBitmap
 
 
 def fit_in_polygon(p, nearby_polygons):
+    # nearby_polygons: list of polygons or a TileIndex (=> query the neighbours)
+    if isinstance(nearby_polygons, TileIndex):
+        nearby_polygons = nearby_polygons.query(p)
     # Remove parts from polygon which overlap with existing ones:
     for p_there in nearby_polygons: 
         p = p.difference(p_there)
+    metrics.count_geos(len(nearby_polygons))
     # only keep largest part if polygon consists of multiple fragments:
     if p.geom_type=='MultiPolygon':
-        i_largest = np.argmax([p_i.area for p_i in p])
-        p = p[i_largest]
+        i_largest = np.argmax([p_i.area for p_i in p.geoms])
+        p = p.geoms[i_largest]
     # remove pathologic polygons with holes (rare event):
-    if p.type not in ['MultiLineString','LineString', 'GeometryCollection']:
+    if p.geom_type not in ['MultiLineString','LineString', 'GeometryCollection']:
         if p.interiors: # check for attribute interiors if accessible
             p = Polygon(list(p.exterior.coords))
     return p
 
 
-def place_tiles_along_chains(chains, angles_0to180, half_tile, RAND_SIZE, MAX_ANGLE, A0, plot=[]):
-    # construct tiles along ductus chain
-    RAND_EXTRA = int(round(half_tile*RAND_SIZE))  
-    
+def occupancy_bitmap(h, w, half_tile, cell_size=None):
+    # bitmap of the image and a margin for tiles along the border, cells of about half_tile pixels
+    margin = 2*half_tile
+    return OccupancyBitmap((-margin, -margin, w+margin, h+margin), cell_size or half_tile)
+
+
+def tiles_along_chain(chain, angles_0to180, half_tile, RAND_EXTRA, MAX_ANGLE, A0, index, rng=random):
+    # construct tiles along one ductus chain, new tiles are also added to index
+    # rng: source of random numbers (random module or random.Random instance)
     polygons = []
-    t0 = time.time()
     delta_i = int(half_tile*2) # width of standard tile (i.e. on straight lines)
-    for ik, chain in enumerate(chains):
-    
-        # consider existing polygons next to the new lane (reason: speed)
-        search_area = LineString(np.array(chain)[:,::-1]).buffer(2.1*half_tile)
-        preselected_nearby_polygons = [poly for poly in polygons if poly.intersects(search_area)]
-    
-        for i in range(len(chain)):
-            y,x = chain[i]
-            winkel = angles_0to180[y,x]
-            
-            if i == 0: # at the beginning save the first side of the future polygon
-                i_start = i
-                rand_i = random.randint(-RAND_EXTRA,+RAND_EXTRA) # a<=x<=b
-                winkel_start = winkel
-                line_start = LineString([(x,y-half_tile),(x,y+half_tile)])
-                line_start = affinity.rotate(line_start, -winkel_start)
-            
-            # Draw polygon as soon as one of the three conditions is fullfilled:
-            draw_polygon = False
-            # 1. end of chain is reached
-            if i==len(chain)-1: 
+    for i in range(len(chain)):
+        y,x = chain[i]
+        winkel = angles_0to180[y,x]
+        
+        if i == 0: # at the beginning save the first side of the future polygon
+            i_start = i
+            rand_i = rng.randint(-RAND_EXTRA,+RAND_EXTRA) # a<=x<=b
+            winkel_start = winkel
+            line_start = LineString([(x,y-half_tile),(x,y+half_tile)])
+            line_start = affinity.rotate(line_start, -winkel_start)
+        
+        # Draw polygon as soon as one of the three conditions is fullfilled:
+        draw_polygon = False
+        # 1. end of chain is reached
+        if i==len(chain)-1: 
+            draw_polygon = True
+        else:
+            y_next, x_next = chain[i+1]
+            winkel_next = angles_0to180[y_next,x_next]
+            winkeldelta = winkel_next-winkel_start
+            winkeldelta = min( 180-abs(winkeldelta), abs(winkeldelta))     
+            # 2. with the NEXT point a large angle would be reached => draw now
+            if winkeldelta > MAX_ANGLE:
+                draw_polygon = True
+            # 3. goal width is reached
+            if i-i_start == delta_i+rand_i:
                 draw_polygon = True
-            else:
-                y_next, x_next = chain[i+1]
-                winkel_next = angles_0to180[y_next,x_next]
-                winkeldelta = winkel_next-winkel_start
-                winkeldelta = min( 180-abs(winkeldelta), abs(winkeldelta))     
-                # 2. with the NEXT point a large angle would be reached => draw now
-                if winkeldelta > MAX_ANGLE:
-                    draw_polygon = True
-                # 3. goal width is reached
-                if i-i_start == delta_i+rand_i:
-                    draw_polygon = True
-                    
-            if draw_polygon:
-                
-                line = LineString([(x,y-half_tile),(x,y+half_tile)])
-                line = affinity.rotate(line, -winkel)
-    
-                # construct new tile
-                p = MultiPoint([line_start.coords[0], line_start.coords[1], line.coords[0], line.coords[1]])
-                p = p.convex_hull
                 
-                line_start = line
-                winkel_start = winkel
-    
-                # do not draw very thin polygon, but set as new starting point (line_start) to skip critical area
-                if i-i_start <= 2: 
-                    i_start = i
-                    continue
+        if draw_polygon:
+            
+            line = LineString([(x,y-half_tile),(x,y+half_tile)])
+            line = affinity.rotate(line, -winkel)
+
+            # construct new tile
+            p = MultiPoint([line_start.coords[0], line_start.coords[1], line.coords[0], line.coords[1]])
+            p = p.convex_hull
+            metrics.count_geos(2) # rotate, convex hull
+            
+            line_start = line
+            winkel_start = winkel
+
+            # do not draw very thin polygon, but set as new starting point (line_start) to skip critical area
+            if i-i_start <= 2: 
                 i_start = i
-                rand_i = random.randint(-RAND_EXTRA,+RAND_EXTRA) # a<=x<=b
-    
-                # cut off areas that overlap with already existing tiles
-                nearby_polygons = [poly for poly in preselected_nearby_polygons if p.disjoint(poly)==False]
-                p = fit_in_polygon(p, nearby_polygons)
-                
-                # Sort out small tiles
-                if p.area >= 0.08*A0 and p.geom_type=='Polygon' and p.is_valid: 
-                    polygons += [p]
-                    preselected_nearby_polygons += [p]
+                continue
+            i_start = i
+            rand_i = rng.randint(-RAND_EXTRA,+RAND_EXTRA) # a<=x<=b
+
+            # cut off areas that overlap with already existing tiles
+            # (only existing polygons next to the new tile are considered, reason: speed)
+            p = fit_in_polygon(p, index)
             
-    print (f'Placed {len(polygons)} tiles along guidelines', f'{time.time()-t0:.1f}s') 
+            # Sort out small tiles
+            metrics.count_geos(2) # area, is_valid
+            if p.area >= 0.08*A0 and p.geom_type=='Polygon' and p.is_valid: 
+                polygons += [p]
+                index.insert(p)
+    return polygons
+
+
+def place_tiles_along_chains(chains, angles_0to180, half_tile, RAND_SIZE, MAX_ANGLE, A0, plot=[], index=None):
+    # construct tiles along ductus chain
+    # index: optional TileIndex which is updated with the new tiles (for reuse in later stages)
+    RAND_EXTRA = int(round(half_tile*RAND_SIZE))  
+    
+    polygons = []
+    if index is None:
+        index = TileIndex(2*half_tile)
+    with metrics.stage('place_tiles_along_chains') as record:
+        for ik, chain in enumerate(chains):
+            polygons += tiles_along_chain(chain, angles_0to180, half_tile, RAND_EXTRA, MAX_ANGLE, A0, index)
+        record.update(chains=len(chains), n_out=len(polygons))
     
     if 'polygons_chains' in plot: 
         plotting.draw_tiles(polygons, None, h=0,w=0, background_brightness=0.2,
@@ -104,50 +124,162 @@ def place_tiles_along_chains(chains, angles_0to180, half_tile, RAND_SIZE, MAX_AN
 
 
 
-def place_tiles_into_gaps(polygons, filler_chains, half_tile, A0, plot=[]):
+def split_chain(chain, labels):
+    # runs of consecutive points with the same label => list of (label, part of the chain)
+    breaks = np.flatnonzero(np.diff(labels))+1
+    starts, ends = [0]+breaks.tolist(), breaks.tolist()+[len(chain)]
+    return [(labels[i0], chain[i0:i1]) for i0,i1 in zip(starts, ends)]
+
+
+def partition_chains(chains, h, w, partitions):
+    # split the chains at the borders of a ny*nx grid, each part goes to the region it is in
+    # (=> overlaps only along the borders, similar work per region)
+    ny,nx = partitions
+    regions = [[] for i in range(ny*nx)]
+    for chain in chains:
+        yx = np.asarray(chain).reshape((-1,2))
+        iy = np.minimum(yx[:,0]*ny//h, ny-1)
+        ix = np.minimum(yx[:,1]*nx//w, nx-1)
+        for region, part in split_chain(chain, iy*nx+ix):
+            regions[region] += [part]
+    return regions
+
+
+_shared = {} # angles_0to180 inside of worker processes
+
+def _init_region_worker(name, shape, dtype):
+    _shared['memory'] = shared_memory.SharedMemory(name=name)
+    _shared['angles_0to180'] = np.ndarray(shape, dtype=dtype, buffer=_shared['memory'].buf)
+
+
+def _init_region_worker_file(fname):
+    # memory-mapped angles (large images) => each worker only reads the pages of its regions
+    _shared['angles_0to180'] = np.load(fname, mmap_mode='r')
+
+
+def _place_region(task):
+    i_region, chains, half_tile, RAND_EXTRA, MAX_ANGLE, A0, seed = task
+    rng = random.Random(f'{seed}-{i_region}') # independent of the number of processes
+    index = TileIndex(2*half_tile)
+    polygons = []
+    for chain in chains:
+        polygons += tiles_along_chain(chain, _shared['angles_0to180'], half_tile, RAND_EXTRA, MAX_ANGLE, A0, index, rng)
+    return polygons
+
+
+def place_tiles_along_chains_parallel(chains, angles_0to180, half_tile, RAND_SIZE, MAX_ANGLE, A0, plot=[], index=None,
+                                      partitions=(2,2), processes=None, seed=0):
+    # same as place_tiles_along_chains, but the image is split into regions (ny*nx grid)
+    # which are processed in parallel; overlaps of tiles along the region borders
+    # are removed in a final sequential pass => results only depend on seed and partitions
+    RAND_EXTRA = int(round(half_tile*RAND_SIZE))
+    h,w = angles_0to180.shape[0],angles_0to180.shape[1]
+    regions = partition_chains(chains, h, w, partitions)
+    tasks = [(i, region, half_tile, RAND_EXTRA, MAX_ANGLE, A0, seed) for i,region in enumerate(regions)]
+
+    with metrics.stage('place_tiles_along_chains_parallel') as record:
+        # share the angles with the worker processes instead of copying them into each task
+        # (GEOS operations inside of the worker processes are not counted)
+        with metrics.stage('regions', n_in=len(chains)) as record_regions:
+            if isinstance(angles_0to180, np.memmap) and angles_0to180.filename: # already in a file (*.npy)
+                with Pool(processes, initializer=_init_region_worker_file, initargs=(angles_0to180.filename,)) as pool:
+                    region_polygons = pool.imap(_place_region, tasks) # regions one after another
+                    region_polygons = list(region_polygons)
+            else:
+                memory = shared_memory.SharedMemory(create=True, size=max(angles_0to180.nbytes, 1))
+                try:
+                    np.ndarray(angles_0to180.shape, dtype=angles_0to180.dtype, buffer=memory.buf)[:] = angles_0to180
+                    with Pool(processes, initializer=_init_region_worker,
+                              initargs=(memory.name, angles_0to180.shape, angles_0to180.dtype)) as pool:
+                        region_polygons = pool.map(_place_region, tasks)
+                finally:
+                    memory.close()
+                    memory.unlink()
+            record_regions.update(regions=len(regions), n_out=sum(len(region) for region in region_polygons))
+
+        # resolve overlaps with tiles of other regions (seams)
+        polygons = []
+        if index is None:
+            index = TileIndex(2*half_tile)
+        with metrics.stage('seams', n_in=record_regions['n_out']) as record_seams:
+            counter = 0
+            for region in region_polygons:
+                n_before = len(index) # tiles of the same region do not overlap
+                for p in region:
+                    nearby_polygons = [index.polygons[i] for i in index.query_ids(p) if i < n_before]
+                    if nearby_polygons:
+                        counter += 1
+                        p = fit_in_polygon(p, nearby_polygons)
+                        metrics.count_geos(2)
+                        if not (p.area >= 0.08*A0 and p.geom_type=='Polygon' and p.is_valid):
+                            continue
+                    polygons += [p]
+                    index.insert(p)
+            record_seams.update(cut=counter, n_out=len(polygons))
+        record.update(chains=len(chains), n_out=len(polygons))
+
+    if 'polygons_chains' in plot: 
+        plotting.draw_tiles(polygons, None, h=0,w=0, background_brightness=0.2,
+                            return_svg=False, chains=chains, axis_off=True)
+    return polygons
+
+
+def place_tiles_into_gaps(polygons, filler_chains, half_tile, A0, plot=[], index=None):
     # fill spaces which are still empty after the main construction step
-    t0 = time.time()
+    # index: optional TileIndex which already contains all polygons (e.g. from place_tiles_along_chains)
+    polygons = list(polygons) # (the list of the caller may be memoized, see dag.StageGraph)
     counter = 0
-    for chain in filler_chains:
-        # Speed up:
-        chain_as_line = LineString(np.array(chain)[:,::-1]).buffer(2.1*half_tile) # ::-1 weil x und y vertauscht werden muss
-        preselected_nearby_polygons = [poly for poly in polygons if poly.intersects(chain_as_line)]
-        # Sicherstellen, dass am Ende der Kette nichts verschenkt wird
-        index_list = list(range(0, len(chain), half_tile*2))
-        last_i = len(chain)-1
-        min_delta = 3
-        if index_list[-1] != last_i and last_i-index_list[-1]>=min_delta:
-            index_list += [last_i]
-        for i in index_list:
-            y,x = chain[i]
-            p = Polygon([[x-half_tile, y+half_tile], [x+half_tile, y+half_tile],
-                         [x+half_tile, y-half_tile], [x-half_tile, y-half_tile]])
-            # fit in polygon (concave ones are okay for now)
-            p_buff = p.buffer(0.1)
-            nearby_polygons = [poly for poly in preselected_nearby_polygons if p_buff.intersects(poly)] 
-            for p_vorhanden in nearby_polygons:
-                try:
-                    p = p.difference(p_vorhanden) # => remove overlap
-                except:
-                    p = p.difference(p_vorhanden.buffer(0.1)) # => remove overlap
-            # keep only largest fragment if more than one exists
-            if p.geom_type=='MultiPolygon':
-                i_largest = np.argmax([p_i.area for p_i in p])
-                p = p[i_largest]
-            if p.area >= 0.05*A0 and p.geom_type=='Polygon': # sort out very small tiles
-                polygons += [p]
-                preselected_nearby_polygons += [p]
-                counter += 1
+    if index is None:
+        # (size of the image from the chains, which are all inside of it)
+        h, w = np.max([xy for chain in filler_chains for xy in chain], axis=0)+1 if filler_chains else (0, 0)
+        index = TileIndex(2*half_tile, polygons, bitmap=occupancy_bitmap(h, w, half_tile))
+    bitmap = index.bitmap
+    with metrics.stage('place_tiles_into_gaps', n_in=len(polygons)) as record:
+        for chain in filler_chains:
+            # Sicherstellen, dass am Ende der Kette nichts verschenkt wird
+            index_list = list(range(0, len(chain), half_tile*2))
+            last_i = len(chain)-1
+            min_delta = 3
+            if index_list[-1] != last_i and last_i-index_list[-1]>=min_delta:
+                index_list += [last_i]
+            for i in index_list:
+                y,x = chain[i]
+                # bitmap: covered squares are dropped, free squares are kept as they are (same as with GEOS)
+                if bitmap is not None and bitmap.is_covered((x-half_tile, y-half_tile, x+half_tile, y+half_tile)):
+                    metrics.add('prefilter_covered')
+                    continue
+                p = Polygon([[x-half_tile, y+half_tile], [x+half_tile, y+half_tile],
+                             [x+half_tile, y-half_tile], [x-half_tile, y-half_tile]])
+                if bitmap is not None and bitmap.is_free((x-half_tile-0.1, y-half_tile-0.1, x+half_tile+0.1, y+half_tile+0.1)):
+                    metrics.add('prefilter_free')
+                    nearby_polygons = []
+                else:
+                    # fit in polygon (concave ones are okay for now)
+                    p_buff = p.buffer(0.1)
+                    nearby_polygons = index.query(p_buff) # Speed up
+                metrics.count_geos(2+len(nearby_polygons)) # buffer, area, difference
+                for p_vorhanden in nearby_polygons:
+                    try:
+                        p = p.difference(p_vorhanden) # => remove overlap
+                    except:
+                        p = p.difference(p_vorhanden.buffer(0.1)) # => remove overlap
+                # keep only largest fragment if more than one exists
+                if p.geom_type=='MultiPolygon':
+                    i_largest = np.argmax([p_i.area for p_i in p.geoms])
+                    p = p.geoms[i_largest]
+                if p.area >= 0.05*A0 and p.geom_type=='Polygon': # sort out very small tiles
+                    polygons += [p]
+                    index.insert(p)
+                    counter += 1
+        record.update(chains=len(filler_chains), added=counter, n_out=len(polygons))
     if 'polygons_filler' in plot: 
         plotting.draw_tiles(polygons, None, h=0,w=0, background_brightness=0.2,
                             return_svg=False, chains=filler_chains, axis_off=True)                
-    print (f'Added {counter} tiles into gaps:', f'{time.time()-t0:.1f}s')
     return polygons
 
 
 def cut_tiles_outside_frame(polygons, half_tile, w, h, plot=[]):
     # remove parts of tiles which are outside of the actual image
-    t0 = time.time()
     A0 = (2*half_tile)**2
     outer = Polygon([ (-3*half_tile,-3*half_tile),(h+3*half_tile,-3*half_tile),
                           (h+3*half_tile,w+3*half_tile),(-3*half_tile,w+3*half_tile) ],
@@ -155,17 +287,20 @@ def cut_tiles_outside_frame(polygons, half_tile, w, h, plot=[]):
                         )
     polygons_cut = []
     counter = 0
-    for j,p in enumerate(polygons):
-        y,x = list(p.representative_point().coords)[0]
-        if y<4*half_tile or y>h-4*half_tile or x<4*half_tile or x>w-4*half_tile:
-            p = p.difference(outer) # => if outside image borders
-            counter += 1
-        if p.area >= 0.05*A0 and p.geom_type=='Polygon':
-            polygons_cut += [p]
+    with metrics.stage('cut_tiles_outside_frame', n_in=len(polygons)) as record:
+        for j,p in enumerate(polygons):
+            y,x = list(p.representative_point().coords)[0]
+            metrics.count_geos(2) # representative point, area
+            if y<4*half_tile or y>h-4*half_tile or x<4*half_tile or x>w-4*half_tile:
+                p = p.difference(outer) # => if outside image borders
+                counter += 1
+                metrics.count_geos(1)
+            if p.area >= 0.05*A0 and p.geom_type=='Polygon':
+                polygons_cut += [p]
+        record.update(cut=counter, n_out=len(polygons_cut)) # up to counter tiles beyond image borders were cut
     if 'polygons_cut' in plot: 
         plotting.draw_tiles(polygons_cut, None, h=0,w=0, background_brightness=0.2,
                             return_svg=False, chains=None, axis_off=True)              
-    print (f'Up to {counter} tiles beyond image borders were cut', f'{time.time()-t0:.1f}s') 
     return polygons_cut
 
 
@@ -179,6 +314,7 @@ def irregular_shrink(polygons, half_tile):
         #p = affinity.rotate(p, random.uniform(-5,5))
         #p = affinity.skew(p, random.uniform(-5,5),random.uniform(-5,5))
         polygons_shrinked += [p]
+    metrics.count_geos(2*len(polygons))
     return polygons_shrinked
 
 
@@ -187,15 +323,15 @@ def repair_tiles(polygons):
     # remove or correct strange polygons
     polygons_new = []
     for p in polygons:
-        if p.type == 'MultiPolygon':
-            for pp in p:
+        if p.geom_type == 'MultiPolygon':
+            for pp in p.geoms:
                 polygons_new += [pp]
         else:
             polygons_new += [p]
     
     polygons_new2 = []
     for p in polygons_new:
-        if p.exterior.type == 'LinearRing':
+        if p.exterior.geom_type == 'LinearRing':
             polygons_new2 += [p]
     
     return polygons_new2
@@ -206,21 +342,66 @@ def reduce_edge_count(polygons, half_tile, tol=20):
     for p in polygons:
         p = p.simplify(tolerance=half_tile/tol)
         polygons_new += [p]
+    metrics.count_geos(len(polygons))
     return polygons_new
 
 
 def drop_small_tiles(polygons, A0, threshold=0.03):
     polygons_new = []
     counter = 0
-    for p in polygons:
-        if p.area > threshold*A0:
-            polygons_new += [p]
-        else:
-            counter += 1
-    print (f'Dropped {counter} small tiles ')
+    with metrics.stage('drop_small_tiles', n_in=len(polygons)) as record:
+        for p in polygons:
+            if p.area > threshold*A0:
+                polygons_new += [p]
+            else:
+                counter += 1
+        metrics.count_geos(len(polygons))
+        record.update(dropped=counter, n_out=len(polygons_new))
     return polygons_new
 
 
 
+def post_process(polygons, half_tile, A0, tol=20, threshold=0.03):
+    # irregular_shrink + repair_tiles + reduce_edge_count + drop_small_tiles in one stage,
+    # all tiles are processed at once as geometry arrays (needs shapely >= 2.0)
+    with metrics.stage('post_process', n_in=len(polygons)) as record:
+        if not hasattr(shapely, 'get_parts'): # older shapely => one tile after another
+            polygons = irregular_shrink(polygons, half_tile)
+            polygons = repair_tiles(polygons)
+            polygons = reduce_edge_count(polygons, half_tile, tol)
+            polygons = drop_small_tiles(polygons, A0, threshold)
+        elif len(polygons):
+            polygons, dropped = post_process_arrays(polygons, half_tile, A0, tol, threshold)
+            record['dropped'] = dropped
+        record['n_out'] = len(polygons)
+    return polygons
 
 
+def post_process_arrays(polygons, half_tile, A0, tol, threshold, return_index=False):
+    # return_index: also return the number of the original tile of each resulting tile
+
+    # random scale factors are drawn in the same order as in irregular_shrink
+    factors = np.array([(random.uniform(0.85, 1), random.uniform(0.85, 1)) for p in polygons])
+    geoms = np.array(polygons, dtype=object)
+    
+    # irregular shrink: scale each tile around the center of its bounding box
+    bounds = shapely.bounds(geoms)
+    centers = (bounds[:,:2]+bounds[:,2:])/2
+    coords, i_geom = shapely.get_coordinates(geoms, return_index=True)
+    offsets = centers - centers*factors
+    coords = coords*factors[i_geom] + offsets[i_geom]
+    geoms = shapely.set_coordinates(geoms.copy(), coords)
+    geoms = shapely.buffer(geoms, -0.03*half_tile, quad_segs=16) # same resolution as p.buffer()
+    
+    # repair: split multipolygons into single tiles
+    geoms, index = shapely.get_parts(geoms, return_index=True)
+    polygon = shapely.get_type_id(geoms)==3 # polygons only
+    geoms, index = geoms[polygon], index[polygon]
+    
+    # simplify and drop very small tiles
+    geoms = shapely.simplify(geoms, tolerance=half_tile/tol)
+    keep = shapely.area(geoms) > threshold*A0
+    metrics.count_geos(3*len(polygons)+3*len(geoms)) # bounds, set coordinates, buffer, parts, simplify, area
+    if return_index:
+        return list(geoms[keep]), int(np.count_nonzero(~keep)), index[keep]
+    return list(geoms[keep]), int(np.count_nonzero(~keep))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact array-backed storage of finished mosaics
+=======================================================================
+All corners of all tiles are kept in one contiguous (N,2) array, the corners
+of tile i are coords[offsets[i]:offsets[i+1]] (without closing point).
+Colors, areas and centroids are columns with one row per tile. Shapely
+polygons are only created when needed (and then cached).
+
+    tiles = TileSet.from_polygons(result.polygons, result.colors, result.h, result.w)
+    tiles.save('mosaic.npz') # single file
+    tiles.save('mosaic_tiles') # directory of *.npy files => load() maps them into memory
+    tiles = TileSet.load('mosaic.npz')
+    export.write_svg(tiles, tiles.colors, tiles.h, tiles.w, 'mosaic.svg')
+    part = tiles[1000:2000] # TileSet which shares the corners (no shapely polygons)
+"""
+
+import json
+from pathlib import Path
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
+import export
+
+
+class TileSet(object):
+    # coords: corners of all tiles (x,y), offsets: start of each tile in coords (+ end of last tile)
+    # colors: rgb (0...1) of each tile or None
+
+    def __init__(self, coords, offsets, colors=None, h=None, w=None):
+        self.coords = coords
+        self.offsets = offsets
+        self.colors = colors
+        self.h, self.w = h, w
+        self._polygons = None
+        self._area = self._centroid = None
+
+    @classmethod
+    def from_polygons(cls, polygons, colors=None, h=None, w=None):
+        coords, counts = export.tile_corners(polygons)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        if colors is not None and len(colors):
+            colors = export.rgb_array(colors, len(polygons))/255 if isinstance(colors[0], str) \
+                     else np.asarray(colors, dtype=np.float64)[:,:3]
+        else:
+            colors = None
+        return cls(np.ascontiguousarray(coords, dtype=np.float64), offsets, colors, h, w)
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    @property
+    def counts(self):
+        # number of corners of each tile
+        return np.diff(self.offsets)
+
+    def corners(self, i):
+        return self.coords[self.offsets[i]:self.offsets[i+1]]
+
+    def _shoelace(self):
+        # area and centroid of all tiles at once
+        x, y = self.coords[:,0], self.coords[:,1]
+        nxt = np.arange(1, len(x)+1) # next corner of the same tile
+        counts = self.counts
+        nxt[self.offsets[1:][counts>0]-1] = self.offsets[:-1][counts>0]
+        cross = x*y[nxt] - x[nxt]*y
+        tile = np.repeat(np.arange(len(self)), counts)
+        a = np.bincount(tile, cross, minlength=len(self))/2
+        cx = np.bincount(tile, (x+x[nxt])*cross, minlength=len(self))
+        cy = np.bincount(tile, (y+y[nxt])*cross, minlength=len(self))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            centroid = np.stack([cx, cy], axis=1)/(6*a[:,None])
+        self._area, self._centroid = np.abs(a), centroid
+
+    @property
+    def area(self):
+        if self._area is None:
+            self._shoelace()
+        return self._area
+
+    @property
+    def centroid(self):
+        if self._centroid is None:
+            self._shoelace()
+        return self._centroid
+
+    @property
+    def polygons(self):
+        # list of shapely polygons (created on first use)
+        if self._polygons is None:
+            if hasattr(shapely, 'polygons'): # shapely >= 2.0 => all tiles at once
+                closed = np.insert(self.coords, self.offsets[1:], self.coords[self.offsets[:-1]], axis=0)
+                rings = shapely.linearrings(closed, indices=np.repeat(np.arange(len(self)), self.counts+1))
+                self._polygons = list(shapely.polygons(rings))
+            else:
+                self._polygons = [Polygon(self.corners(i)) for i in range(len(self))]
+        return self._polygons
+
+    def __getitem__(self, i):
+        # index => shapely polygon, slice => TileSet (view of the corners for consecutive tiles)
+        if not isinstance(i, slice):
+            return self.polygons[i]
+        start, stop, step = i.indices(len(self))
+        colors = self.colors[i] if self.colors is not None else None
+        if step == 1:
+            stop = max(start, stop)
+            offsets = self.offsets[start:stop+1]
+            part = TileSet(self.coords[offsets[0]:offsets[-1]], offsets-offsets[0], colors, self.h, self.w)
+        else:
+            tiles = np.arange(start, stop, step, dtype=np.int64)
+            counts = self.counts[tiles]
+            starts = np.repeat(self.offsets[tiles], counts)
+            k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts, counts) # corner number inside the tile
+            part = TileSet(self.coords[starts+k], np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                           colors, self.h, self.w)
+        if self._polygons is not None:
+            part._polygons = self._polygons[i]
+        return part
+
+    def __iter__(self):
+        return iter(self.polygons)
+
+    def save(self, fname):
+        # *.npz => one file, otherwise directory with one *.npy per column (=> memory-mapped by load)
+        arrays = dict(coords=self.coords, offsets=self.offsets)
+        if self.colors is not None:
+            arrays['colors'] = self.colors
+        meta = dict(h=self.h, w=self.w)
+        if str(fname).endswith('.npz'):
+            np.savez(fname, meta=json.dumps(meta), **arrays)
+            return
+        path = Path(fname)
+        path.mkdir(parents=True, exist_ok=True)
+        for name,array in arrays.items():
+            np.save(path / f'{name}.npy', array)
+        with open(path / 'meta.json', 'w') as fn:
+            json.dump(meta, fn)
+
+    @classmethod
+    def load(cls, fname, mmap=True):
+        # mmap: map the columns of a directory into memory instead of reading them
+        if str(fname).endswith('.npz'):
+            with np.load(fname) as arrays:
+                meta = json.loads(str(arrays['meta']))
+                return cls(arrays['coords'], arrays['offsets'],
+                           arrays['colors'] if 'colors' in arrays else None, meta['h'], meta['w'])
+        path = Path(fname)
+        mode = 'r' if mmap else None
+        with open(path / 'meta.json') as fn:
+            meta = json.load(fn)
+        colors = np.load(path / 'colors.npy', mmap_mode=mode) if (path / 'colors.npy').exists() else None
+        return cls(np.load(path / 'coords.npy', mmap_mode=mode), np.load(path / 'offsets.npy', mmap_mode=mode),
+                   colors, meta['h'], meta['w'])
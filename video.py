@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sequence mode: animated mosaics from the frames of a clip
+=======================================================================
+Frames are processed in order. The edge map and the guidelines of each frame
+are compared with those of the previous frame: tiles are kept where nothing
+changed (=> they stay in place), only in changed regions tiles are placed
+again (along the new guidelines and into the gaps around the kept tiles).
+All tiles get their colors from the current frame.
+
+    sequence = MosaicSequence(MosaicConfig(half_tile=8))
+    for frame in frames: # filenames or image arrays
+        result = sequence.next(frame) # => result.polygons, result.colors, result.metrics['kept']
+
+Frames can be a video file (read with openCV), a directory or a glob pattern.
+"""
+
+import matplotlib
+matplotlib.use('Agg') # no display needed
+import json
+import random
+import time
+from dataclasses import replace
+from pathlib import Path
+import cv2
+import numpy as np
+import shapely
+import guides, tiles, convex, coloring, export, metrics, render
+from pipeline import MosaicConfig, MosaicPipeline, MosaicResult
+from spatial import TileIndex
+from batch import find_images
+
+
+def read_frames(inputs):
+    # video file => rgb arrays, directory or glob pattern => file names (sorted)
+    if Path(inputs).is_file():
+        capture = cv2.VideoCapture(str(inputs))
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        finally:
+            capture.release()
+    else:
+        yield from find_images(inputs)
+
+
+def box_sums(mask):
+    # summed-area table => number of True pixels inside of any box in constant time
+    sums = np.zeros((mask.shape[0]+1, mask.shape[1]+1), dtype=np.int64)
+    sums[1:,1:] = mask.cumsum(0).cumsum(1)
+    return sums
+
+
+def touches(sums, bounds, h, w):
+    # True for each tile whose bounding box contains a pixel of the mask
+    bounds = np.asarray(bounds).reshape((-1,4))
+    x0 = np.clip(np.floor(bounds[:,0]), 0, w).astype(int)
+    y0 = np.clip(np.floor(bounds[:,1]), 0, h).astype(int)
+    x1 = np.clip(np.ceil(bounds[:,2])+1, 0, w).astype(int)
+    y1 = np.clip(np.ceil(bounds[:,3])+1, 0, h).astype(int)
+    return (sums[y1,x1]-sums[y0,x1]-sums[y1,x0]+sums[y0,x0]) > 0
+
+
+def moved(a, b):
+    # pixels of a or b which are not within one pixel of the other one (=> tolerates jitter of the lines)
+    kernel = np.ones((3,3), np.uint8)
+    a, b = a.astype(np.uint8), b.astype(np.uint8)
+    return ((a > 0) & (cv2.dilate(b, kernel) == 0)) | ((b > 0) & (cv2.dilate(a, kernel) == 0))
+
+
+def chains_inside(chains, mask, min_length=3):
+    # parts of the chains (runs of consecutive points) inside of the mask
+    parts = []
+    for chain in chains:
+        yx = np.asarray(chain)
+        inside = mask[yx[:,0], yx[:,1]]
+        if inside.any():
+            parts += [part for is_inside, part in tiles.split_chain(chain, inside) if is_inside and len(part) >= min_length]
+    return parts
+
+
+class MosaicSequence(object):
+    # keeps the tiles of the previous frame: pairs of (tile before post-processing, its post-processed tiles)
+
+    def __init__(self, config=None, verbose=False, callback=None, **params):
+        self.pipeline = MosaicPipeline(config, verbose=verbose, callback=callback, memoize=False, **params)
+        self.config = self.pipeline.config
+        self.verbose = verbose
+        self.callback = callback
+        self.n_frames = 0
+        self.edges = None # edge map of the previous frame
+        self.guidelines = None # pixels of the chains of the previous frame
+        self.tiles = [] # (raw, [post-processed tiles]) of the previous frame
+
+    def changed_mask(self, img_edges, guidelines):
+        # pixels where edges or guidelines changed, grown by the size of a tile
+        # (tiles next to a change are placed again as well)
+        if self.edges is None or self.edges.shape != img_edges.shape:
+            return np.ones(img_edges.shape[:2], dtype=bool)
+        changed = moved(img_edges != 0, self.edges != 0) | moved(guidelines, self.guidelines)
+        size = 4*self.config.half_tile+1
+        return cv2.dilate(changed.astype(np.uint8), np.ones((size, size), np.uint8)) > 0
+
+    def place(self, chains, angles_0to180, changed, kept):
+        # new tiles in the changed regions, fitted around the kept tiles
+        c = self.config
+        h,w = changed.shape
+        index = TileIndex(2*c.half_tile, kept)
+        RAND_EXTRA = int(round(c.half_tile*c.rand_size))
+        with metrics.stage('place_tiles_along_chains', n_in=len(kept)) as record:
+            polygons = []
+            for chain in chains_inside(chains, changed):
+                polygons += tiles.tiles_along_chain(chain, angles_0to180, c.half_tile, RAND_EXTRA, c.max_angle, c.A0, index)
+            record['n_out'] = len(polygons)
+        with metrics.stage('place_tiles_into_gaps', n_in=len(polygons)) as record:
+            filler_chains = guides.chains_into_gaps(kept+polygons, h, w, c.half_tile, c.gap_chain_spacing, region=changed,
+                                                    low_memory=c.low_memory)
+            polygons = tiles.place_tiles_into_gaps(kept+polygons, filler_chains, c.half_tile, c.A0)[len(kept):]
+            polygons = tiles.cut_tiles_outside_frame(polygons, c.half_tile, h, w)
+            record['n_out'] = len(polygons)
+        if c.make_convex:
+            polygons = convex.make_convex(polygons, c.half_tile, c.A0, processes=c.processes)
+        return polygons
+
+    def post_process(self, polygons):
+        # post-processed tiles of each tile (=> kept tiles keep their shape in later frames)
+        c = self.config
+        groups = [[] for p in polygons]
+        with metrics.stage('post_process', n_in=len(polygons)) as record:
+            if not c.post_process:
+                groups = [[p] for p in polygons]
+            elif hasattr(shapely, 'get_parts') and len(polygons):
+                parts, dropped, index = tiles.post_process_arrays(polygons, c.half_tile, c.A0, c.post_tolerance,
+                                                                  c.drop_threshold, return_index=True)
+                for p,i in zip(parts, index):
+                    groups[i] += [p]
+            else: # older shapely
+                groups = [tiles.post_process([p], c.half_tile, c.A0, c.post_tolerance, c.drop_threshold) for p in polygons]
+            record['n_out'] = sum(len(g) for g in groups)
+        return groups
+
+    def next(self, image, recorder=None):
+        # image: filename or image array of the next frame
+        c = self.config
+        if recorder is None:
+            recorder = metrics.Recorder(verbose=self.verbose, callback=self.callback)
+        n_records = len(recorder.records)
+        with metrics.use(recorder):
+            random.seed(f'{c.seed}-{self.n_frames}')
+            with metrics.stage('load_image'):
+                img0 = self.pipeline.load(image)
+            h,w = img0.shape[:2]
+            with metrics.stage('edges'):
+                img_edges = self.pipeline.find_edges(img0)
+            with metrics.stage('chains_and_angles'):
+                chains, angles_0to180 = guides.chains_and_angles(img_edges, c.half_tile, low_memory=c.low_memory)
+                guidelines = np.zeros((h, w), dtype=bool)
+                if chains:
+                    yx = np.concatenate([np.asarray(chain) for chain in chains])
+                    guidelines[yx[:,0], yx[:,1]] = True
+
+            with metrics.stage('keep_tiles', n_in=len(self.tiles)) as record:
+                changed = self.changed_mask(img_edges, guidelines)
+                if self.tiles:
+                    raw = [p for p,parts in self.tiles]
+                    keep = ~touches(box_sums(changed), [p.bounds for p in raw], h, w)
+                    self.tiles = [t for t,k in zip(self.tiles, keep) if k]
+                record.update(changed=float(changed.mean()), n_out=len(self.tiles))
+            kept = [p for p,parts in self.tiles]
+            new = self.place(chains, angles_0to180, changed, kept)
+            self.tiles += list(zip(new, self.post_process(new)))
+
+            polygons = [q for p,parts in self.tiles for q in parts]
+            with metrics.stage('colors', n_in=len(polygons)):
+                colors = coloring.colors_from_original(polygons, img0, method=c.color_method, statistic=c.color_statistic)
+        self.edges, self.guidelines = img_edges, guidelines
+        self.n_frames += 1
+
+        report = recorder.report(start=n_records)
+        report.update(kept=len(kept), new=len(new))
+        timings = {r['name']:r['wall'] for r in report['stages'] if r['depth']==0}
+        return MosaicResult(polygons=polygons, colors=colors, h=h, w=w, timings=timings, metrics=report)
+
+
+def run_sequence(inputs, out_dir, config=None, formats=('png',), scale=1.0, verbose=False):
+    # inputs: video file, directory or glob pattern of frames
+    # writes frame_00000.png ... (and/or svg, svgz, npz) and sequence_summary.json into out_dir
+    config = replace(config or MosaicConfig(), plot=[])
+    sequence = MosaicSequence(config, verbose=verbose)
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    records = []
+    t_start = time.time()
+    for i, frame in enumerate(read_frames(inputs)):
+        t0 = time.time()
+        result = sequence.next(frame)
+        stem = Path(out_dir) / f'frame_{i:05d}'
+        for fmt in ['svg', 'svgz']:
+            if fmt in formats:
+                export.write_svg(result.polygons, result.colors, result.h, result.w, f'{stem}.{fmt}')
+        if 'npz' in formats:
+            result.tileset().save(f'{stem}.npz')
+        for fmt in ['png', 'tif']:
+            if fmt in formats:
+                render.write_image(result.polygons, result.colors, result.h, result.w, f'{stem}.{fmt}', scale=scale)
+        records += [dict(frame=i, tiles=len(result.polygons), kept=result.metrics['kept'], new=result.metrics['new'],
+                         seconds=time.time()-t0, timings=result.timings)]
+        print (f'frame {i}: {len(result.polygons)} tiles, {result.metrics["kept"]} kept, {time.time()-t0:.1f}s')
+    summary = dict(frames=len(records), seconds=time.time()-t_start, records=records)
+    with open(Path(out_dir) / 'sequence_summary.json', 'w') as fn:
+        json.dump(summary, fn, indent=1)
+    return summary